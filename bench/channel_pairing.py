@@ -0,0 +1,129 @@
+import contextlib
+import io
+import time
+
+from node import context
+from node.channel import NodeChannel
+from node.migrator import NodeMigrator
+
+
+class HubNode(NodeMigrator):
+    # In-memory stand-in for NodeMigrator: keeps channels, trust lines and own keys
+    # without touching the filesystem or SQLite
+    def __init__(self, ctx, node_name):
+        self.ctx = ctx
+        self.node_name = node_name
+        self.new_node_address = "127.0.0.1:2000"
+        self.channel_idx = 0
+        self.channels = dict()
+        self.trust_lines = dict()
+        self.trust_lines_by_contractor = dict()
+        self.trust_lines_by_equivalent = dict()
+        self.own_keys = dict()
+        self.contractor_keys_count = 0
+
+    def add_channel(self, pk, sk, ok, id_on_contractor_side, contractor_address):
+        channel = context.Channel()
+        self.channels[self.channel_idx] = channel
+        channel.id = self.channel_idx
+        channel.id_on_contractor_side = id_on_contractor_side
+        self.channel_idx += 1
+
+    def add_synthetic_trust_line(self, trust_line_id, contractor_id, equivalent, own_keys_count):
+        trust_line = context.TrustLine()
+        trust_line.id = trust_line_id
+        trust_line.contractor_id = contractor_id
+        trust_line.equivalent = equivalent
+        self.index_trust_line(trust_line)
+        own_keys = []
+        for number in range(own_keys_count):
+            own_key = context.OwnKey()
+            own_key.hash = (self.node_name + ":" + str(trust_line_id) + ":" + str(number)).encode()
+            own_key.trust_line_id = trust_line_id
+            own_key.keys_set_sequence_number = 1
+            own_key.number = number
+            own_key.is_valid = 1
+            own_keys.append(own_key)
+        self.own_keys[trust_line_id] = own_keys
+
+    def load_own_keys(self, trust_line_id):
+        return self.own_keys.get(trust_line_id, [])
+
+    def add_contractor_key(self, own_key1, own_key2):
+        self.contractor_keys_count += 1
+
+
+class ChannelPairingBenchmark:
+    def __init__(self, ctx, trust_lines_count=5000, own_keys_count=10, equivalents_count=2):
+        self.ctx = ctx
+        self.trust_lines_count = trust_lines_count
+        self.own_keys_count = own_keys_count
+        self.equivalents_count = equivalents_count
+
+    def construct_hub(self):
+        hub = HubNode(self.ctx, "hub")
+        channels = []
+        contractors_count = max(1, self.trust_lines_count // self.equivalents_count)
+        trust_line_id = 1
+        for c in range(contractors_count):
+            leaf = HubNode(self.ctx, "leaf_" + str(c))
+            channel = NodeChannel(hub, leaf)
+            channel.id_on_contractor_side1 = leaf.channel_idx
+            channel.id_on_contractor_side2 = hub.channel_idx
+            hub.add_channel(None, None, None, channel.id_on_contractor_side1, None)
+            leaf.add_channel(None, None, None, channel.id_on_contractor_side2, None)
+            for eq in range(self.equivalents_count):
+                hub.add_synthetic_trust_line(
+                    trust_line_id, channel.id_on_contractor_side2, eq, self.own_keys_count)
+                leaf.add_synthetic_trust_line(
+                    trust_line_id, channel.id_on_contractor_side1, eq, self.own_keys_count)
+                trust_line_id += 1
+            channels.append(channel)
+        return hub, channels
+
+    @staticmethod
+    def generate_contractor_keys_by_scanning(channel):
+        # Pairing as it was done before the trust line and own key indexes were introduced
+        for trust_line1 in channel.node1.trust_lines.values():
+            if trust_line1.contractor_id != channel.id_on_contractor_side2:
+                continue
+            channel1 = channel.node1.channels.get(trust_line1.contractor_id, None)
+            channel2 = channel.node2.channels.get(channel1.id_on_contractor_side, None)
+
+            own_keys1 = channel.node1.load_own_keys(trust_line1.id)
+            for trust_line2 in channel.node2.trust_lines.values():
+                if trust_line2.contractor_id != channel.id_on_contractor_side1:
+                    continue
+                if trust_line2.contractor_id != channel2.id or \
+                        trust_line1.equivalent != trust_line2.equivalent:
+                    continue
+
+                own_keys2 = channel.node2.load_own_keys(trust_line2.id)
+                for own_key1 in own_keys1:
+                    if own_key1.trust_line_id != trust_line1.id:
+                        continue
+                    for own_key2 in own_keys2:
+                        if own_key2.trust_line_id != trust_line2.id or \
+                                own_key1.number != own_key2.number:
+                            continue
+                        channel.node1.add_contractor_key(own_key1, own_key2)
+                        channel.node2.add_contractor_key(own_key2, own_key1)
+
+    def measure(self, generate):
+        hub, channels = self.construct_hub()
+        start_time = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            for channel in channels:
+                generate(channel)
+        return time.perf_counter() - start_time, hub.contractor_keys_count
+
+    def run(self):
+        print("Channel pairing: hub with " + str(self.trust_lines_count) + " trust lines, " +
+              str(self.own_keys_count) + " own keys per trust line, " +
+              str(self.equivalents_count) + " equivalents")
+        scan_time, scan_keys = self.measure(self.generate_contractor_keys_by_scanning)
+        index_time, index_keys = self.measure(NodeChannel.generate_contractor_keys)
+        assert scan_keys == index_keys, "Scanning and indexed pairing produced different contractor keys"
+        print("\tScanning: {:.3f} sec".format(scan_time))
+        print("\tIndexed:  {:.3f} sec".format(index_time))
+        print("\tSpeedup:  {:.1f}x, contractor keys: {}".format(scan_time / max(index_time, 1e-9), index_keys))
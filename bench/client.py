@@ -0,0 +1,43 @@
+import hashlib
+import os
+import sqlite3
+import sys
+
+# Stand-in for the modified network client run by migrate.py in every new node directory.
+# The first run generates own keys of every trust line, once contractor keys are there
+# a run signs the audits. Keys and signatures are derived from the node and trust line,
+# so runs are reproducible. Usage: python bench/client.py [own keys per trust line]
+
+
+def derive(*parts, size=32):
+    return hashlib.blake2b(":".join(str(part) for part in parts).encode(), digest_size=size).digest()
+
+
+def main():
+    own_keys_count = int(sys.argv[1]) if len(sys.argv) > 1 else 2
+    node_name = os.path.basename(os.getcwd())
+    storage_con = sqlite3.connect(os.path.join("io", "storageDB"))
+    with_own_keys = {row[0] for row in storage_con.execute("SELECT DISTINCT trust_line_id FROM own_keys;")}
+    with_contractor_keys = {
+        row[0] for row in storage_con.execute("SELECT DISTINCT trust_line_id FROM contractor_keys;")}
+    for (trust_line_id,) in storage_con.execute("SELECT id FROM trust_lines;").fetchall():
+        if trust_line_id not in with_own_keys:
+            storage_con.executemany(
+                "INSERT INTO own_keys (hash, trust_line_id, keys_set_sequence_number, public_key, private_key, "
+                "number, is_valid) VALUES (?, ?, 1, ?, ?, ?, 1);",
+                ((derive(node_name, trust_line_id, number, "hash"), trust_line_id,
+                  derive(node_name, trust_line_id, number, "public"),
+                  derive(node_name, trust_line_id, number, "private", size=64), number)
+                 for number in range(own_keys_count)))
+        elif trust_line_id in with_contractor_keys:
+            storage_con.execute(
+                "UPDATE audit SET our_key_hash = ?, our_signature = ?, own_keys_set_hash = ? "
+                "WHERE trust_line_id = ?;",
+                (derive(node_name, trust_line_id, "key"), derive(node_name, trust_line_id, "signature", size=64),
+                 derive(node_name, trust_line_id, "keys set"), trust_line_id))
+    storage_con.commit()
+    storage_con.close()
+
+
+if __name__ == "__main__":
+    main()
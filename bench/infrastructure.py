@@ -0,0 +1,154 @@
+import itertools
+import json
+import os
+import random
+import shutil
+import sqlite3
+import uuid
+
+
+class SyntheticInfrastructure:
+    # Old infrastructure made up from a seed: every node directory has conf.json, io/storageDB and
+    # io/communicatorStorageDB, as check.py, migrate.py and compare.py --offline read them. Trust line
+    # ends are drawn with weight 1 / rank ** hubs_exponent, so a few hubs hold most of the trust lines.
+    # users_addresses.csv and new_equivalents.csv are written next to the old infrastructure.
+    TRUST_LINE_RECORD_TYPE = 1
+    PAYMENT_RECORD_TYPE = 2
+    PAYMENT_RECORD_SHARE = 0.7
+    TIMESTAMP_BEGIN = 1500000000000000
+
+    def __init__(self, work_path, nodes_count=100, trust_lines_per_node=10, history_per_node=100,
+                 hubs_exponent=1.0, equivalents=(1, 2), unknown_share=0.05, transactions_per_node=0, seed=1):
+        self.work_path = work_path
+        self.old_infrastructure_path = os.path.join(work_path, "old")
+        self.new_infrastructure_path = os.path.join(work_path, "new")
+        self.nodes_count = nodes_count
+        self.trust_lines_per_node = trust_lines_per_node
+        self.history_per_node = history_per_node
+        self.hubs_exponent = hubs_exponent
+        self.equivalents = equivalents
+        self.unknown_share = unknown_share
+        self.transactions_per_node = transactions_per_node
+        self.seed = seed
+        self.random = None
+        self.trust_lines_count = 0
+        self.hub_trust_lines_count = 0
+        self.history_count = 0
+
+    def random_uuid(self):
+        return uuid.UUID(int=self.random.getrandbits(128), version=4)
+
+    def random_amount(self, limit):
+        return self.random.randint(0, limit).to_bytes(32, 'big')
+
+    @staticmethod
+    def balance_bytes(balance):
+        # One leading byte more than an amount, 1 for a negative balance
+        return (b'\x01' if balance < 0 else b'\x00') + abs(balance).to_bytes(32, 'big')
+
+    def draw_trust_lines(self, node_uuids):
+        # Trust lines of every node as (contractor uuid, equivalent, incoming, outgoing, balance),
+        # both ends of a trust line see the same amounts mirrored
+        cum_weights = list(itertools.accumulate(
+            1.0 / (rank + 1) ** self.hubs_exponent for rank in range(self.nodes_count)))
+        trust_lines = {node_uuid: [] for node_uuid in node_uuids}
+        pairs = set()
+        pairs_count = self.nodes_count * self.trust_lines_per_node // 2
+        for attempt in range(pairs_count * 10):
+            if len(pairs) >= pairs_count:
+                break
+            idx1, idx2 = self.random.choices(range(self.nodes_count), cum_weights=cum_weights, k=2)
+            equivalent = self.random.choice(self.equivalents)
+            pair = (min(idx1, idx2), max(idx1, idx2), equivalent)
+            if idx1 == idx2 or pair in pairs:
+                continue
+            pairs.add(pair)
+            incoming = self.random.randint(0, 1000000)
+            outgoing = self.random.randint(0, 1000000)
+            balance = self.random.randint(-min(incoming, outgoing), min(incoming, outgoing)) \
+                if self.random.random() < 0.5 else 0
+            node_uuid1, node_uuid2 = node_uuids[idx1], node_uuids[idx2]
+            trust_lines[node_uuid1].append((node_uuid2, equivalent, incoming, outgoing, balance))
+            trust_lines[node_uuid2].append((node_uuid1, equivalent, outgoing, incoming, -balance))
+        self.trust_lines_count = len(pairs) * 2
+        return trust_lines
+
+    def history_rows(self, node_trust_lines):
+        for h in range(self.history_per_node):
+            if len(node_trust_lines) == 0 or self.random.random() < self.unknown_share:
+                contractor = str(self.random_uuid())
+                equivalent = self.random.choice(self.equivalents)
+            else:
+                contractor, equivalent = self.random.choice(node_trust_lines)[:2]
+            record_body = bytes([self.random.randint(1, 3)]) + uuid.UUID(contractor).bytes + \
+                self.random_amount(100000)
+            record_type = self.TRUST_LINE_RECORD_TYPE
+            if self.random.random() < self.PAYMENT_RECORD_SHARE:
+                record_type = self.PAYMENT_RECORD_TYPE
+                record_body += self.balance_bytes(self.random.randint(-100000, 100000))
+            yield (self.random_uuid().bytes, self.TIMESTAMP_BEGIN + h * 1000000, record_type,
+                   record_body, len(record_body), equivalent, None)
+
+    def generate_node(self, node_idx, node_uuid, node_trust_lines):
+        node_path = os.path.join(self.old_infrastructure_path, node_uuid)
+        os.makedirs(os.path.join(node_path, "io"))
+        with open(os.path.join(node_path, "conf.json"), 'w') as conf_file:
+            json.dump({
+                "node": {"uuid": node_uuid},
+                "network": {"interface": "127.0.0.1", "port": 2000 + node_idx},
+                "uuid2address": {"host": "127.0.0.1", "port": 1500}
+            }, conf_file, sort_keys=True, indent=4)
+
+        storage_con = sqlite3.connect(os.path.join(node_path, "io", "storageDB"))
+        storage_con.execute(
+            "CREATE TABLE trust_lines (contractor BLOB NOT NULL, incoming_amount BLOB NOT NULL, "
+            "outgoing_amount BLOB NOT NULL, balance BLOB NOT NULL, is_contractor_gateway INTEGER NOT NULL, "
+            "equivalent INTEGER NOT NULL);")
+        storage_con.execute(
+            "CREATE TABLE history (operation_uuid BLOB NOT NULL, operation_timestamp INTEGER NOT NULL, "
+            "record_type INTEGER NOT NULL, record_body BLOB NOT NULL, record_body_bytes_count INT NOT NULL, "
+            "equivalent INTEGER NOT NULL, command_uuid BLOB);")
+        storage_con.execute(
+            "CREATE TABLE transactions (transaction_uuid BLOB NOT NULL, transaction_body BLOB NOT NULL, "
+            "transaction_bytes_count INT NOT NULL);")
+        storage_con.executemany(
+            "INSERT INTO trust_lines VALUES (?, ?, ?, ?, 0, ?);",
+            ((uuid.UUID(contractor).bytes, incoming.to_bytes(32, 'big'), outgoing.to_bytes(32, 'big'),
+              self.balance_bytes(balance), equivalent)
+             for contractor, equivalent, incoming, outgoing, balance in node_trust_lines))
+        storage_con.executemany(
+            "INSERT INTO history VALUES (?, ?, ?, ?, ?, ?, ?);", self.history_rows(node_trust_lines))
+        storage_con.executemany(
+            "INSERT INTO transactions VALUES (?, ?, ?);",
+            ((self.random_uuid().bytes, b'\x00' * 16, 16) for t in range(self.transactions_per_node)))
+        storage_con.commit()
+        storage_con.close()
+        self.history_count += self.history_per_node
+
+        communicator_con = sqlite3.connect(os.path.join(node_path, "io", "communicatorStorageDB"))
+        communicator_con.execute(
+            "CREATE TABLE communicator_messages_queue (contractor_uuid BLOB NOT NULL, "
+            "transaction_uuid BLOB NOT NULL, message_type INTEGER NOT NULL, recording_time INTEGER NOT NULL, "
+            "equivalent INTEGER NOT NULL);")
+        communicator_con.commit()
+        communicator_con.close()
+
+    def generate(self):
+        self.random = random.Random(self.seed)
+        self.history_count = 0
+        shutil.rmtree(self.old_infrastructure_path, ignore_errors=True)
+        shutil.rmtree(self.new_infrastructure_path, ignore_errors=True)
+        os.makedirs(self.old_infrastructure_path)
+
+        node_uuids = [str(self.random_uuid()) for n in range(self.nodes_count)]
+        trust_lines = self.draw_trust_lines(node_uuids)
+        for node_idx, node_uuid in enumerate(node_uuids):
+            self.generate_node(node_idx, node_uuid, trust_lines[node_uuid])
+
+        with open(os.path.join(self.work_path, "users_addresses.csv"), 'w') as csv_file:
+            for node_idx, node_uuid in enumerate(node_uuids):
+                csv_file.write(node_uuid + ";user_" + str(node_idx + 1) + "#geo.pay\n")
+        with open(os.path.join(self.work_path, "new_equivalents.csv"), 'w') as csv_file:
+            for equivalent in self.equivalents:
+                csv_file.write(str(equivalent) + ";" + str(100 + equivalent) + "\n")
+        self.hub_trust_lines_count = max(len(node_trust_lines) for node_trust_lines in trust_lines.values())
@@ -0,0 +1,20 @@
+import json
+import os
+import runpy
+import sys
+
+# Runs a script of the repository with its migration settings overridden, so it works on
+# a synthetic infrastructure. Usage: python bench/launch.py settings.json script.py [args]
+
+root_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root_path)
+
+import settings
+
+
+if __name__ == "__main__":
+    with open(sys.argv[1]) as settings_file:
+        settings.migration_conf.update(json.load(settings_file))
+    script_path = os.path.join(root_path, sys.argv[2])
+    sys.argv = sys.argv[2:]
+    runpy.run_path(script_path, run_name="__main__")
@@ -0,0 +1,104 @@
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+
+
+class PipelineBenchmark:
+    # Times the migration scripts on a synthetic infrastructure: check.py, migrate.py and
+    # compare.py --offline, every one in its own process as they are run for real. The network
+    # client of migrate.py is replaced by bench/client.py, compare.py --offline runs no nodes.
+    def __init__(self, ctx, infrastructure, jobs=None, own_keys_count=2):
+        self.ctx = ctx
+        self.infrastructure = infrastructure
+        self.jobs = jobs
+        self.own_keys_count = own_keys_count
+        self.bench_path = os.path.dirname(os.path.abspath(__file__))
+        self.settings_path = os.path.join(infrastructure.work_path, "benchmark_settings.json")
+        self.report_path = os.path.join(infrastructure.work_path, "benchmark_pipeline.json")
+
+    def save_settings(self):
+        client_path = sys.executable + " " + os.path.join(self.bench_path, "client.py") + " " + \
+            str(self.own_keys_count)
+        self.ctx.save_json({
+            "old_infrastructure_path": self.infrastructure.old_infrastructure_path,
+            "new_infrastructure_path": self.infrastructure.new_infrastructure_path,
+            "mod_network_client_path": client_path,
+            "old_network_client_path": "/bin/false",
+            "new_network_client_path": "/bin/false",
+            "old_uuid_2_address_path": "/bin/true",
+            "debug": False
+        }, self.settings_path)
+
+    def run_script(self, name, args):
+        log_path = os.path.join(self.infrastructure.work_path, name.replace(" ", "_") + ".log")
+        start_time = time.perf_counter()
+        with open(log_path, 'w') as log_file:
+            script_proc = subprocess.run(
+                [sys.executable, os.path.join(self.bench_path, "launch.py"), self.settings_path] + args,
+                cwd=self.infrastructure.work_path, stdout=log_file, stderr=subprocess.STDOUT)
+        elapsed_time = time.perf_counter() - start_time
+        # Scripts that ran nodes end by killing themselves
+        if script_proc.returncode not in (0, -signal.SIGKILL):
+            assert False, name + " exited with " + str(script_proc.returncode) + ", see " + log_path
+        return elapsed_time, log_path
+
+    @staticmethod
+    def outcome(log_path):
+        with open(log_path) as log_file:
+            for line in log_file:
+                if "SUCCESS" in line or "FAILURE" in line:
+                    return line.strip()
+        return "no outcome"
+
+    def run(self):
+        infrastructure = self.infrastructure
+        print("Pipeline: " + str(infrastructure.nodes_count) + " nodes, " +
+              str(infrastructure.trust_lines_per_node) + " trust lines per node (hubs exponent " +
+              str(infrastructure.hubs_exponent) + "), " + str(infrastructure.history_per_node) +
+              " history rows per node, seed " + str(infrastructure.seed))
+        print("\tWork directory: " + infrastructure.work_path)
+        start_time = time.perf_counter()
+        infrastructure.generate()
+        steps = {"generate": time.perf_counter() - start_time}
+        print("\tGenerated {} trust lines (hub has {}), {} history rows in {:.3f} sec".format(
+            infrastructure.trust_lines_count, infrastructure.hub_trust_lines_count,
+            infrastructure.history_count, steps["generate"]))
+
+        self.save_settings()
+        migrate_args = ["migrate.py", "-o", "127.0.0.1:4000"]
+        if self.jobs is not None:
+            migrate_args += ["-j", str(self.jobs)]
+        for name, args in (
+                ("check", ["check.py"]),
+                ("migrate", migrate_args),
+                ("compare offline", ["compare.py", "--offline"])):
+            steps[name], log_path = self.run_script(name, args)
+            print("\t{:<16} {:.3f} sec".format(name + ":", steps[name]))
+            if name == "compare offline":
+                print("\t\t" + self.outcome(log_path))
+
+        # Phases of the migration as profiled by migrate.py itself
+        profile_path = os.path.join(infrastructure.new_infrastructure_path, "migration_profile.json")
+        with open(profile_path) as profile_file:
+            phases = json.load(profile_file)["phases"]
+        for totals in phases:
+            print("\t\t{:<18} {:.3f} sec, cpu {:.3f} sec (children {:.3f} sec), rows read {}, written {}".format(
+                totals["phase"] + ":", totals["wall"], totals["cpu"], totals["children_cpu"],
+                totals["rows_read"], totals["rows_written"]))
+
+        self.ctx.save_json({
+            "nodes": infrastructure.nodes_count,
+            "trust_lines_per_node": infrastructure.trust_lines_per_node,
+            "history_per_node": infrastructure.history_per_node,
+            "hubs_exponent": infrastructure.hubs_exponent,
+            "seed": infrastructure.seed,
+            "jobs": self.jobs,
+            "trust_lines": infrastructure.trust_lines_count,
+            "hub_trust_lines": infrastructure.hub_trust_lines_count,
+            "steps": steps,
+            "migrate_phases": phases
+        }, self.report_path)
+        print("\tReport: " + self.report_path)
@@ -0,0 +1,52 @@
+import gc
+import tracemalloc
+
+from node import context
+
+
+class DictHistory:
+    # History record layout as it was before node.context records got __slots__
+    def __init__(self):
+        self.operation_uuid = None
+        self.operation_timestamp = None
+        self.record_type = None
+        self.record_body = None
+        self.record_body_bytes_count = None
+        self.equivalent = None
+        self.command_uuid = None
+
+
+class RecordsMemoryBenchmark:
+    def __init__(self, ctx, rows_count=1000000):
+        self.ctx = ctx
+        self.rows_count = rows_count
+
+    def measure(self, history_class):
+        # Field values are shared between records, so only the per-record overhead is measured
+        row = (b'\x00' * 16, 1500000000, 2, b'\x01' * 64, 64, 1001, None)
+        gc.collect()
+        tracemalloc.start()
+        histories = []
+        for r in range(self.rows_count):
+            history = history_class()
+            histories.append(history)
+            history.operation_uuid = row[0]
+            history.operation_timestamp = row[1]
+            history.record_type = row[2]
+            history.record_body = row[3]
+            history.record_body_bytes_count = row[4]
+            history.equivalent = row[5]
+            history.command_uuid = row[6]
+        used_bytes, peak_bytes = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del histories
+        return used_bytes / self.rows_count
+
+    def run(self):
+        print("Records memory: " + str(self.rows_count) + " synthetic history rows")
+        dict_bytes = self.measure(DictHistory)
+        slots_bytes = self.measure(context.History)
+        print("\tWith __dict__:   {:.1f} bytes per record".format(dict_bytes))
+        print("\tWith __slots__:  {:.1f} bytes per record".format(slots_bytes))
+        print("\tSaved:           {:.1f} MB per {} records".format(
+            (dict_bytes - slots_bytes) * self.rows_count / (1024 * 1024), self.rows_count))
@@ -0,0 +1,117 @@
+import getopt
+import os
+import sys
+import tempfile
+import time
+
+from bench.channel_pairing import ChannelPairingBenchmark
+from bench.infrastructure import SyntheticInfrastructure
+from bench.pipeline import PipelineBenchmark
+from bench.records_memory import RecordsMemoryBenchmark
+
+from node import context
+
+
+class Main(context.Context):
+    def __init__(self):
+        super().__init__()
+        self.scenarios = []
+        self.trust_lines_count = 5000
+        self.own_keys_count = 10
+        self.rows_count = 1000000
+        self.work_path = None
+        self.nodes_count = 100
+        self.node_trust_lines_count = 10
+        self.node_history_count = 100
+        self.hubs_exponent = 1.0
+        self.seed = 1
+        try:
+            opts, args = getopt.getopt(sys.argv[1:], "hvs:n:k:r:j:",
+                                       ["help", "scenario=", "trust-lines=", "own-keys=", "rows=", "jobs=",
+                                        "work=", "nodes=", "node-trust-lines=", "node-history=", "hubs-exponent=",
+                                        "seed="])
+        except getopt.GetoptError as err:
+            print(str(err))
+            self.usage()
+            sys.exit(2)
+        for o, a in opts:
+            if o == "-v":
+                self.verbose = True
+            elif o in ("-h", "--help"):
+                self.usage()
+                sys.exit()
+            elif o in ("-s", "--scenario"):
+                self.scenarios.append(a)
+            elif o in ("-n", "--trust-lines"):
+                self.trust_lines_count = int(a)
+            elif o in ("-k", "--own-keys"):
+                self.own_keys_count = int(a)
+            elif o in ("-r", "--rows"):
+                self.rows_count = int(a)
+            elif o in ("-j", "--jobs"):
+                self.jobs = int(a)
+            elif o == "--work":
+                self.work_path = os.path.abspath(a)
+            elif o == "--nodes":
+                self.nodes_count = int(a)
+            elif o == "--node-trust-lines":
+                self.node_trust_lines_count = int(a)
+            elif o == "--node-history":
+                self.node_history_count = int(a)
+            elif o == "--hubs-exponent":
+                self.hubs_exponent = float(a)
+            elif o == "--seed":
+                self.seed = int(a)
+            else:
+                assert False, "unhandled option"
+        self.in_memory = True
+
+    def benchmark(self):
+        benchmarks = {
+            "channel_pairing": lambda: ChannelPairingBenchmark(self, self.trust_lines_count, self.own_keys_count),
+            "records_memory": lambda: RecordsMemoryBenchmark(self, self.rows_count),
+            "pipeline": lambda: PipelineBenchmark(self, self.synthetic_infrastructure(), self.jobs),
+        }
+        scenarios = self.scenarios if len(self.scenarios) > 0 else benchmarks.keys()
+        for scenario in scenarios:
+            if scenario not in benchmarks:
+                assert False, "Unknown scenario " + scenario
+            print()
+            benchmarks[scenario]().run()
+
+    def synthetic_infrastructure(self):
+        if self.work_path is None:
+            self.work_path = tempfile.mkdtemp(prefix="geo_benchmark_")
+        os.makedirs(self.work_path, exist_ok=True)
+        return SyntheticInfrastructure(self.work_path, self.nodes_count, self.node_trust_lines_count,
+                                       self.node_history_count, self.hubs_exponent, seed=self.seed)
+
+    @staticmethod
+    def usage():
+        print("Usage:")
+        print("\tpython benchmark.py [-v] [-s scenario] [-n trust lines] [-k own keys] [-r rows] [-j jobs]"
+              " [--work path] [--nodes count] [--node-trust-lines count] [--node-history count]"
+              " [--hubs-exponent exponent] [--seed seed]")
+        print("\t[-s --scenario] : Run only this scenario (channel_pairing, records_memory, pipeline), may be repeated")
+        print("\t[-n --trust-lines] : Number of trust lines of the synthetic hub node")
+        print("\t[-k --own-keys] : Number of own keys per trust line")
+        print("\t[-r --rows] : Number of synthetic history rows for records_memory")
+        print("\t[-j --jobs] : Number of processes of migrate.py in pipeline")
+        print("\t[--work] : Directory of the synthetic infrastructure for pipeline (default a new temporary one)")
+        print("\t[--nodes] : Number of synthetic nodes for pipeline (default 100)")
+        print("\t[--node-trust-lines] : Average number of trust lines per node for pipeline (default 10)")
+        print("\t[--node-history] : Number of history rows per node for pipeline (default 100)")
+        print("\t[--hubs-exponent] : Trust line ends are drawn with weight 1 / rank ** exponent, "
+              "higher exponents make bigger hubs (default 1.0)")
+        print("\t[--seed] : Seed of the synthetic infrastructure, the same seed makes the same one (default 1)")
+        print("Example:")
+        print("\tpython benchmark.py -s channel_pairing -n 5000")
+        print("\tpython benchmark.py -s pipeline --nodes 1000 --node-trust-lines 20 --node-history 1000 -j 4")
+
+
+if __name__ == "__main__":
+    start_time = time.time()
+    Main().benchmark()
+    hours, rem = divmod(time.time() - start_time, 3600)
+    minutes, seconds = divmod(rem, 60)
+    print("Finished in {:0>2}:{:0>2}:{:05.2f}".format(int(hours), int(minutes), seconds))
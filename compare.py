@@ -1,13 +1,18 @@
+import concurrent.futures
 import datetime
 import getopt
-import json
+import multiprocessing
 import os
+import queue
 import sys
 import threading
 import time
 import csv
 
 from node.comparator import NodeComparator
+from node.comparision_store import ComparisionStore
+from node.comparision_differ import ComparisionDiffer
+from node.supervisor import NodeSupervisor
 
 from node import context
 from settings import migration_conf
@@ -16,10 +21,20 @@ from settings import migration_conf
 class Main(context.Context):
     def __init__(self, custom_args=None, files_prefix=""):
         super().__init__()
+        self.warm_nodes = 4
+        self.order_by_cost = False
+        self.comparing_time = 0.0
+        self.progress_channel = None
+        self.processes = None
+        self.workers_count = None
+        self.pending_nodes = None
+        self.next_pending_node = None
         try:
             if custom_args is None:
                 custom_args = sys.argv[1:]
-            opts, args = getopt.getopt(custom_args, "hm:t:vc", ["help", "clean", "max-nodes", "threads"])
+            opts, args = getopt.getopt(custom_args, "hm:t:p:vc", ["help", "clean", "max-nodes", "threads", "processes=",
+                                                                "ready-probe=", "ready-timeout=", "warm-nodes=",
+                                                                "order-by-cost", "page-size=", "offline"])
         except getopt.GetoptError as err:
             print(str(err))
             self.usage()
@@ -36,41 +51,77 @@ class Main(context.Context):
                 self.nodes_count_max = int(a)
             elif o in ("-t", "--threads"):
                 self.threads = int(a)
+            elif o in ("-p", "--processes"):
+                self.processes = int(a)
+            elif o == "--ready-probe":
+                assert a in ("marker", "fifo", "ping"), "unknown readiness probe " + a
+                self.node_ready_probe = a
+            elif o == "--ready-timeout":
+                self.node_ready_timeout = float(a)
+            elif o == "--warm-nodes":
+                self.warm_nodes = int(a)
+            elif o == "--order-by-cost":
+                self.order_by_cost = True
+            elif o == "--offline":
+                self.offline = True
+            elif o == "--page-size":
+                self.history_page_size = int(a)
+                assert self.history_page_size > 0, "page size must be positive"
             else:
                 assert False, "unhandled option"
+        self.set_logging_level()
         self.in_memory = True
         self.old_network_client_path = migration_conf.get("old_network_client_path")
         self.new_network_client_path = migration_conf.get("new_network_client_path")
         self.old_uuid_2_address_path = migration_conf.get("old_uuid_2_address_path")
-        self.old_cpm_file_path = os.path.join(self.old_infrastructure_path, files_prefix + "compare.json")
-        self.new_cpm_file_path = os.path.join(self.new_infrastructure_path, files_prefix + "compare.json")
-        self.old_ign_file_path = os.path.join(self.old_infrastructure_path, files_prefix + "ignored.json")
-        self.new_ign_file_path = os.path.join(self.new_infrastructure_path, files_prefix + "ignored.json")
-
-    def batch(self, batch_thread_info):
-        thread_index = batch_thread_info[1]
-        running_thread_path = os.path.join(self.new_infrastructure_path, "thread_" + str(thread_index) + "_lock")
-        with open(running_thread_path, 'w') as cpm_file_out:
-            json.dump({}, cpm_file_out, sort_keys=True, indent=4, ensure_ascii=False)
-
+        self.old_comparision_store = ComparisionStore(
+            os.path.join(self.old_infrastructure_path, files_prefix + "compare.jsonl"))
+        self.new_comparision_store = ComparisionStore(
+            os.path.join(self.new_infrastructure_path, files_prefix + "compare.jsonl"))
+        self.comparision_diff_path = os.path.join(self.new_infrastructure_path, files_prefix + "compare_diff.jsonl")
+
+    def batch(self, worker_index, files_prefix):
+        # Compares the nodes taken from the shared list into the worker's own result files
+        main = None
+        error = None
         try:
-            nodes = batch_thread_info[2]
-            files_prefix = "thread_" + str(thread_index) + "_"
-            main = Main("", files_prefix)
-            batch_thread_info[4] = main
-            if len(nodes) > 0:
-                main.nodes = self.nodes
-                main.nodes_by_address = self.nodes_by_address
-                main.new_equivalents = self.new_equivalents
-                main.verbose = self.verbose
-                main.compare(nodes)
+            main = Main("", files_prefix + str(worker_index) + "_")
+            main.nodes = self.nodes
+            main.nodes_by_address = self.nodes_by_address
+            main.new_equivalents = self.new_equivalents
+            main.verbose = self.verbose
+            main.set_logging_level()
+            main.node_ready_probe = self.node_ready_probe
+            main.node_ready_timeout = self.node_ready_timeout
+            main.warm_nodes = self.warm_nodes
+            main.history_page_size = self.history_page_size
+            main.offline = self.offline
+            main.progress_channel = self.progress_channel
+            main.open_comparision_stores()
+            # A node is taken ahead only while there is enough work left for the other workers
+            main.compare_nodes(main.pull_nodes(self), lambda: self.pending_nodes_left() >= self.workers_count)
         except Exception as e:
-            print(e)
-
-        batch_thread_info[3] = True
-        os.remove(running_thread_path)
+            error = repr(e)
+        finally:
+            summary = None
+            if main is not None:
+                summary = {
+                    "nodes": main.nodes_count_processed,
+                    "busy": main.comparing_time,
+                    "latencies": main.node_start_latencies,
+                    "counters": dict(main.phase_counters.get("compare", {}))
+                }
+            self.progress_channel.put(("finished", worker_index, (error, summary)))
+        return main
+
+    def batch_process(self, worker_index, files_prefix):
+        # A worker process leaves through os._exit, so its queued log records are flushed first
+        try:
+            self.batch(worker_index, files_prefix)
+        finally:
+            self.stop_logging()
 
-    def start_batch(self):
+    def load_pending_nodes(self):
         nodes = os.listdir(self.old_infrastructure_path)
         pending_nodes = []
         number_of_valid_nodes = 0
@@ -98,37 +149,128 @@ class Main(context.Context):
                 continue
             pending_nodes.append(path)
 
-        nodes_per_thread = int(len(pending_nodes) / self.threads + 1)
-        nodes_reserved = 0
-        batch_threads_info = []
-        for t in range(self.threads):
-            nodes_end = min(nodes_reserved + nodes_per_thread, len(pending_nodes))
-            curr_nodes = pending_nodes[nodes_reserved:nodes_end]
-            nodes_reserved = nodes_end
-            batch_thread_info = [None, t, curr_nodes, False, None]
-            batch_thread = \
-                threading.Thread(target=self.batch, args=(batch_thread_info, ))
-            batch_thread.start()
-            batch_thread_info[0] = batch_thread
-            batch_threads_info.append(batch_thread_info)
-
-        time.sleep(1.0)
-        batch_thread_idx = 0
-        for batch_thread_info in batch_threads_info:
-            running_thread_path = os.path.join(self.new_infrastructure_path, "thread_" + str(batch_thread_idx) + "_lock")
-            while os.path.isfile(running_thread_path):
-                time.sleep(1)
-            batch_thread_idx += 1
+        # Workers take the next node from one shared list whenever they are free, so a worker
+        # that got expensive nodes does not hold up the others. Optionally the nodes with
+        # the longest history go first.
+        if self.order_by_cost:
+            print("Estimating nodes cost...")
+            pending_nodes.sort(key=lambda path: self.nodes[path].count_history_rows(), reverse=True)
+        return pending_nodes, number_of_valid_nodes
+
+    def take_next_node(self):
+        with self.next_pending_node.get_lock():
+            node_idx = self.next_pending_node.value
+            if node_idx >= len(self.pending_nodes):
+                return None
+            self.next_pending_node.value = node_idx + 1
+        return self.pending_nodes[node_idx]
+
+    def pending_nodes_left(self):
+        return len(self.pending_nodes) - self.next_pending_node.value
+
+    def start_batch(self):
+        pending_nodes, number_of_valid_nodes = self.load_pending_nodes()
+
+        # Workers are forked, so they share the loaded nodes, the pending list and
+        # its shared position without pickling them
+        pool_context = multiprocessing.get_context("fork")
+        self.pending_nodes = pending_nodes
+        self.next_pending_node = pool_context.Value('i', 0)
+
+        # Workers report every compared node and their own end through the progress channel,
+        # so a failed worker shows up at once
+        batch_start_time = time.time()
+        batch_mains = []
+        if self.processes is not None:
+            self.workers_count = self.processes
+            self.progress_channel = pool_context.Queue()
+            self.open_comparision_stores()
+            workers = []
+            for p in range(self.processes):
+                worker = pool_context.Process(target=self.batch_process, args=(p, "process_"))
+                worker.start()
+                workers.append(worker)
+            # A worker that dies without reporting is noticed by its joiner
+            for p in range(self.processes):
+                threading.Thread(target=self.join_worker, args=(p, workers[p])).start()
+            summaries = self.report_progress(len(pending_nodes), batch_start_time)
+        else:
+            self.workers_count = self.threads
+            self.progress_channel = queue.Queue()
+            with concurrent.futures.ThreadPoolExecutor(self.threads) as workers:
+                futures = [workers.submit(self.batch, t, "thread_") for t in range(self.threads)]
+                summaries = self.report_progress(len(pending_nodes), batch_start_time)
+                batch_mains = [future.result() for future in futures]
+        batch_time = time.time() - batch_start_time
 
         print("Calculating migration outcome...")
         compared_nodes_sum = 0
-        for batch_thread_info in batch_threads_info:
-            if batch_thread_info[4] is None:
+        if self.processes is not None:
+            # Result shards of the workers are appended to the main comparision stores
+            for p in range(self.processes):
+                self.merge_comparision_stores("process_" + str(p) + "_")
+            compared_nodes_sum = self.calculating_migration_outcome()
+        for t in range(len(batch_mains)):
+            if batch_mains[t] is None:
                 continue
-            print("[Thread: "+str(batch_thread_info[1]+1)+"] ", end="")
-            compared_nodes_sum += batch_thread_info[4].calculating_migration_outcome()
+            print("[Thread: "+str(t+1)+"] ", end="")
+            compared_nodes_sum += batch_mains[t].calculating_migration_outcome()
+        for summary in summaries.values():
+            self.node_start_latencies += summary["latencies"]
+            for name, count in summary["counters"].items():
+                self.count_records("compare", name, count)
         print("Nodes compared "+str(compared_nodes_sum)+"/"+str(len(pending_nodes))+"/"+str(number_of_valid_nodes) +
               " : " + str(number_of_valid_nodes - compared_nodes_sum) + " nodes left")
+        self.report_node_start_up()
+        self.log_phase_counters("compare")
+
+        worker_kind = "Process" if self.processes is not None else "Thread"
+        for worker_index in sorted(summaries.keys()):
+            summary = summaries[worker_index]
+            print("[" + worker_kind + ": " + str(worker_index + 1) + "] nodes=" + str(summary["nodes"]) +
+                  " busy={:.2f}s utilisation={:.1f}%".format(
+                      summary["busy"], 100.0 * summary["busy"] / batch_time if batch_time > 0 else 0.0))
+
+    def join_worker(self, worker_index, worker):
+        worker.join()
+        self.progress_channel.put(("exited", worker_index, worker.exitcode))
+
+    def report_progress(self, nodes_count, start_time):
+        summaries = dict()
+        workers_finished = set()
+        nodes_compared = 0
+        nodes_failed = 0
+        while len(workers_finished) < self.workers_count:
+            event, source, result = self.progress_channel.get()
+            if event == "exited":
+                if source not in workers_finished:
+                    workers_finished.add(source)
+                    print("FAILURE: worker " + str(source + 1) + " exited with code " + str(result))
+                continue
+            if event == "finished":
+                workers_finished.add(source)
+                error, summary = result
+                if error is not None:
+                    print("FAILURE: worker " + str(source + 1) + " stopped: " + error)
+                if summary is not None:
+                    summaries[source] = summary
+                continue
+            if event == "compared":
+                nodes_compared += 1
+            else:
+                nodes_failed += 1
+                print("FAILURE: node " + source + " is not compared: " + str(result))
+            nodes_done = nodes_compared + nodes_failed
+            elapsed = time.time() - start_time
+            nodes_per_minute = nodes_done * 60.0 / elapsed if elapsed > 0 else 0.0
+            eta = (nodes_count - nodes_done) * 60.0 / nodes_per_minute if nodes_per_minute > 0 else 0.0
+            hours, rem = divmod(eta, 3600)
+            minutes, seconds = divmod(rem, 60)
+            print("Progress: " + str(nodes_done) + "/" + str(nodes_count) + " nodes" +
+                  " (failed " + str(nodes_failed) + ")" +
+                  " {:.1f} nodes/min".format(nodes_per_minute) +
+                  " ETA {:0>2}:{:0>2}:{:02.0f}".format(int(hours), int(minutes), seconds))
+        return summaries
 
     def compare(self, nodes=None):
         if self.clean:
@@ -144,19 +286,21 @@ class Main(context.Context):
                 self.new_equivalents[row[0]] = row[1]
                 self.new_equivalents[int(row[0])] = int(row[1])
 
-        # Start multithreaded processing
-        if self.threads is not None:
+        # Start multithreaded or multiprocess processing
+        if self.threads is not None or self.processes is not None:
             self.start_batch()
             return
 
-        old_uuid_2_address_dir = self.old_uuid_2_address_path[:self.old_uuid_2_address_path.rindex('/')]
-        print("old_uuid_2_address_dir="+old_uuid_2_address_dir)
-        old_uuid_2_address_thread = threading.Thread(
-            target=self.run_uuid_2_address,
-            args=(old_uuid_2_address_dir, self.old_uuid_2_address_path))
-        old_uuid_2_address_thread.start()
+        # Offline comparision reads the storages only, no node needs to resolve addresses
+        if not self.offline:
+            old_uuid_2_address_dir = self.old_uuid_2_address_path[:self.old_uuid_2_address_path.rindex('/')]
+            print("old_uuid_2_address_dir="+old_uuid_2_address_dir)
+            old_uuid_2_address_thread = threading.Thread(
+                target=self.run_uuid_2_address,
+                args=(old_uuid_2_address_dir, self.old_uuid_2_address_path))
+            old_uuid_2_address_thread.start()
 
-        self.load_comparision_files()
+        self.open_comparision_stores()
 
         print()
         all_nodes = os.listdir(self.old_infrastructure_path) if nodes is None else nodes
@@ -176,76 +320,101 @@ class Main(context.Context):
             self.nodes[node_comparator.node_name] = node_comparator
             self.nodes_by_address[node_comparator.new_node_address] = node_comparator
 
-        for node_comparator in self.nodes_array:
-            if self.nodes_count_processed >= self.nodes_count_max:
-                break
+        self.compare_nodes([node_comparator for node_comparator in self.nodes_array
+                            if not os.path.isfile(os.path.join(node_comparator.new_node_path, "compared.json"))])
+
+    def pull_nodes(self, batch_main):
+        while True:
+            path = batch_main.take_next_node()
+            if path is None:
+                return
+            old_node_path = os.path.join(self.old_infrastructure_path, path)
+            new_node_path = os.path.join(self.new_infrastructure_path, path)
+            node_comparator = NodeComparator(
+                self, path, old_node_path, new_node_path,
+                self.old_network_client_path, self.new_network_client_path,
+                self.old_uuid_2_address_path)
+            self.nodes_array.append(node_comparator)
+            yield node_comparator
+
+    def compare_nodes(self, node_comparators, look_ahead=None):
+        # The next pending node is started ahead while the current one is compared
+        if self.warm_nodes > 0 and not self.offline:
+            self.node_supervisor = NodeSupervisor(self.warm_nodes)
+        node_comparators = iter(node_comparators)
+        node_comparator = next(node_comparators, None)
+        while node_comparator is not None and self.nodes_count_processed < self.nodes_count_max:
+            next_node_comparator = None
+            if self.nodes_count_processed + 1 < self.nodes_count_max and (look_ahead is None or look_ahead()):
+                next_node_comparator = next(node_comparators, None)
+            if self.node_supervisor is not None and next_node_comparator is not None:
+                next_node_comparator.prestart_old_node()
+            start_time = time.time()
             try:
                 node_comparator.compare()
+                if self.progress_channel is not None:
+                    self.progress_channel.put(("compared", node_comparator.node_name, None))
             except Exception as e:
                 print(e)
                 print("Failed to compare node #" + str(node_comparator.node_idx + 1) + ": " + node_comparator.node_name)
-                self.load_comparision_files()
+                if self.progress_channel is not None:
+                    self.progress_channel.put(("failed", node_comparator.node_name, str(e)))
+            self.comparing_time += time.time() - start_time
+            if next_node_comparator is None:
+                next_node_comparator = next(node_comparators, None)
+            node_comparator = next_node_comparator
+        if self.node_supervisor is not None:
+            self.node_supervisor.close()
+            self.node_supervisor = None
 
     def calculating_migration_outcome(self):
         try:
-            old_cpm_obj = json.load(open(self.old_cpm_file_path))
-            old_cpm_file = str(old_cpm_obj)
-            new_cpm_file = str(json.load(open(self.new_cpm_file_path)))
-            if old_cpm_file == new_cpm_file:
-                print("SUCCESS["+str(len(old_cpm_obj))+"]: old and new comparision json files are equal!")
+            nodes_count = self.old_comparision_store.nodes_count()
+            if nodes_count == 0:
+                print("INFO: there are nothing to compare!")
+                return 0
+            # Both stores are walked node by node, mismatching fields are listed in the diff file
+            differ = ComparisionDiffer(self.old_comparision_store, self.new_comparision_store)
+            mismatches_count = differ.write(self.comparision_diff_path)
+            if mismatches_count == 0:
+                print("SUCCESS["+str(nodes_count)+"]: old and new comparision json files are equal!")
             else:
-                print("FAILURE["+str(len(old_cpm_obj))+"]: old and new comparision json files differs!")
-
-            # for node_name in old_cpm_obj.keys():
-            #     print("\tnode: "+str(node_name))
+                print("FAILURE["+str(nodes_count)+"]: old and new comparision json files differs in " +
+                      str(mismatches_count) + " fields, see " + self.comparision_diff_path)
+                for mismatch in differ.samples:
+                    print("\tnode=" + str(mismatch["node"]) + " key=" + str(mismatch["key"]) +
+                          " field=" + str(mismatch["field"]) +
+                          " old=" + str(mismatch["old"]) + " new=" + str(mismatch["new"]))
 
             if 0 != 0:
                 #print()
                 #print("Renaming comparision json files as old...")
                 curr_time = str(datetime.datetime.now())
-                os.rename(self.old_cpm_file_path, self.old_cpm_file_path + "." + curr_time)
-                os.rename(self.new_cpm_file_path, self.new_cpm_file_path + "." + curr_time)
-                os.rename(self.old_ign_file_path, self.old_ign_file_path + "." + curr_time)
-                os.rename(self.new_ign_file_path, self.new_ign_file_path + "." + curr_time)
+                os.rename(self.old_comparision_store.path, self.old_comparision_store.path + "." + curr_time)
+                os.rename(self.new_comparision_store.path, self.new_comparision_store.path + "." + curr_time)
 
-            return len(old_cpm_obj)
+            return nodes_count
         except:
             print("INFO: there are nothing to compare!")
             return 0
 
-    def load_comparision_files(self):
-        print("Loading 'compare.json' files...")
-        try:
-            old_cmp_file = open(self.old_cpm_file_path)
-            new_cmp_file = open(self.new_cpm_file_path)
-            old_ign_file = open(self.old_ign_file_path)
-            new_ign_file = open(self.new_ign_file_path)
-            if old_cmp_file is None or new_cmp_file is None or old_ign_file is None or new_ign_file:
-                assert "start anew"
-            self.old_comparision_json = json.load(old_cmp_file)
-            self.new_comparision_json = json.load(new_cmp_file)
-            self.old_ignored_json = json.load(old_ign_file)
-            self.new_ignored_json = json.load(new_ign_file)
-        except:
-            print("Cannot load 'compare.json' files. Starting anew...")
-            self.old_comparision_json = {}
-            self.new_comparision_json = {}
-            self.old_ignored_json = {}
-            self.new_ignored_json = {}
+    def open_comparision_stores(self):
+        # Stores are only appended to, nodes compared before are read back when needed
+        print("Opening 'compare.jsonl' stores...")
+        self.old_comparision_store.open()
+        self.new_comparision_store.open()
 
-    def save_comparision_files(self):
-        print()
-        print("Saving 'compare.json' files...")
-        with open(self.old_cpm_file_path, 'w') as cpm_file_out:
-            json.dump(self.old_comparision_json, cpm_file_out, sort_keys=True, indent=4, ensure_ascii=False)
-        with open(self.new_cpm_file_path, 'w') as cpm_file_out:
-            json.dump(self.new_comparision_json, cpm_file_out, sort_keys=True, indent=4, ensure_ascii=False)
-
-        print("Saving 'ignored.json' files...")
-        with open(self.old_ign_file_path, 'w') as cpm_file_out:
-            json.dump(self.old_ignored_json, cpm_file_out, sort_keys=True, indent=4, ensure_ascii=False)
-        with open(self.new_ign_file_path, 'w') as cpm_file_out:
-            json.dump(self.new_ignored_json, cpm_file_out, sort_keys=True, indent=4, ensure_ascii=False)
+    def save_node_comparision(self, node_name, old_json_node, old_json_ignored_node, new_json_node, new_json_ignored_node):
+        self.old_comparision_store.save_node(node_name, old_json_node, old_json_ignored_node)
+        self.new_comparision_store.save_node(node_name, new_json_node, new_json_ignored_node)
+
+    def merge_comparision_stores(self, files_prefix):
+        shard = Main("", files_prefix)
+        shard.open_comparision_stores()
+        self.old_comparision_store.merge(shard.old_comparision_store)
+        self.new_comparision_store.merge(shard.new_comparision_store)
+        shard.old_comparision_store.remove()
+        shard.new_comparision_store.remove()
 
     def clean_comparision_data(self, nodes):
         all_nodes = os.listdir(self.old_infrastructure_path) if nodes is None else nodes
@@ -257,7 +426,8 @@ class Main(context.Context):
                     os.remove(old_node_path)
                 except:
                     pass
-            if new_node_path.rfind("compare.json") > -1 or new_node_path.rfind("ignored.json") > -1:
+            if new_node_path.rfind("compare.json") > -1 or new_node_path.rfind("ignored.json") > -1 or \
+                    new_node_path.rfind("compare_diff.jsonl") > -1:
                 try:
                     os.remove(new_node_path)
                 except:
@@ -273,8 +443,15 @@ class Main(context.Context):
     @staticmethod
     def usage():
         print("Usage:")
-        print("\tpython compare.py [-v] [-t threads number] [-m max nodes to process]")
+        print("\tpython compare.py [-v] [-t threads number | -p processes number] [-m max nodes to process]")
         print("\t\t [-c --clean] : clean compared nodes flags")
+        print("\t\t [--ready-probe=marker|fifo|ping] : how to detect that a started node takes commands (default: fifo)")
+        print("\t\t [--ready-timeout=seconds] : how long to wait for a started node (default: 30)")
+        print("\t\t [-p --processes] : compare in worker processes, their results are merged into 'compare.jsonl'")
+        print("\t\t [--order-by-cost] : with threads or processes, compare nodes with the longest history first")
+        print("\t\t [--offline] : read trust lines and history from the old and new storages instead of running the nodes")
+        print("\t\t [--page-size=N] : trust lines and history records requested from a node at once (default: 10000)")
+        print("\t\t [--warm-nodes=N] : node processes kept running per worker, the old client of the next node is started ahead (default: 4, 0 disables)")
         print("Example:")
         print("\tpython compare.py -t 32")
 
@@ -283,12 +460,14 @@ if __name__ == "__main__":
     start_time = time.time()
     main = Main()
     main.compare()
-    if main.threads is None:
+    if main.threads is None and main.processes is None:
         print()
         print("Calculating migration outcome...")
         compared_nodes_sum = main.calculating_migration_outcome()
         print("Nodes compared "+str(compared_nodes_sum)+"/"+str(len(main.nodes)) +
               " : " + str(len(main.nodes) - compared_nodes_sum) + " nodes left")
+        main.report_node_start_up()
+        main.log_phase_counters("compare")
         print()
 
     hours, rem = divmod(time.time() - start_time, 3600)
@@ -1,5 +1,6 @@
 import getopt
 import json
+import multiprocessing
 import os
 import shutil
 import sys
@@ -7,7 +8,10 @@ import time
 import csv
 
 from node import context
+from node.journal import MigrationJournal
 from node.migrator import NodeMigrator
+from node.pool import ConnectionPool
+from node.profiler import PhaseProfiler
 
 from node.channel import NodeChannel
 from settings import migration_conf
@@ -16,8 +20,13 @@ from settings import migration_conf
 class Main(context.Context):
     def __init__(self):
         super().__init__()
+        self.restart = False
+        self.resumed = False
+        self.profile_path = None
         try:
-            opts, args = getopt.getopt(sys.argv[1:], "ha:o:vm", ["help"])
+            opts, args = getopt.getopt(sys.argv[1:], "ha:o:vmj:", [
+                "help", "jobs=", "history-batch=", "stream-history", "open-nodes=", "memory-budget=",
+                "restart", "profile="])
         except getopt.GetoptError as err:
             print(str(err))
             self.usage()
@@ -27,6 +36,20 @@ class Main(context.Context):
                 self.verbose = True
             elif o == "-m":
                 self.in_memory = True
+            elif o in ("-j", "--jobs"):
+                self.jobs = int(a)
+            elif o == "--history-batch":
+                self.history_batch_size = int(a)
+            elif o == "--stream-history":
+                self.stream_history = True
+            elif o == "--open-nodes":
+                self.max_open_nodes = int(a)
+            elif o == "--memory-budget":
+                self.memory_budget = ConnectionPool.parse_size(a)
+            elif o == "--restart":
+                self.restart = True
+            elif o == "--profile":
+                self.profile_path = a
             elif o in ("-h", "--help"):
                 self.usage()
                 sys.exit()
@@ -36,10 +59,17 @@ class Main(context.Context):
                 self.observers = a
             else:
                 assert False, "unhandled option"
+        self.set_logging_level()
         self.observers = self.observers.split(',')
+        if not self.in_memory and (self.max_open_nodes > 0 or self.memory_budget is not None):
+            self.connection_pool = ConnectionPool(self.max_open_nodes, self.memory_budget)
 
         self.mod_network_client_path = migration_conf.get("mod_network_client_path")
         self.unknown_address = migration_conf.get("unknown_address")
+        self.journal = MigrationJournal(os.path.join(self.new_infrastructure_path, "migration_journal.bin"))
+        self.profiler = PhaseProfiler()
+        if self.profile_path is None:
+            self.profile_path = os.path.join(self.new_infrastructure_path, "migration_profile.json")
 
     def migrate(self):
         shutil.rmtree(self.new_infrastructure_path, ignore_errors=True)
@@ -62,7 +92,9 @@ class Main(context.Context):
                 self.new_equivalents[int(row[0])] = int(row[1])
 
         print()
+        # Addresses are assigned here, in listing order, so they do not depend on the number of jobs
         new_node_address = self.address
+        pending_nodes = []
         nodes = os.listdir(self.old_infrastructure_path)
         for path in nodes:
             old_node_path = os.path.join(self.old_infrastructure_path, path)
@@ -73,49 +105,100 @@ class Main(context.Context):
                 continue
             node_migrator = NodeMigrator(self, path, old_node_path,
                                          new_node_path, new_node_address, self.mod_network_client_path)
-            if not self.in_memory:
-                node_migrator.db_connect(False)
-            node_migrator.generate()
-            node_migrator.retrieve_old_data()
-            if not self.in_memory:
-                node_migrator.db_disconnect(False)
             self.nodes[node_migrator.node_name] = node_migrator
+            pending_nodes.append(node_migrator)
             new_node_address = self.increment_node_address(new_node_address)
 
-        channels = NodeChannel.construct_channels(self.nodes)
-        self.channels = channels
+        if self.jobs is None or self.jobs < 2:
+            for node_migrator in pending_nodes:
+                node_migrator.db_acquire()
+                with self.profiler.node_phase("generate", node_migrator):
+                    node_migrator.generate()
+                with self.profiler.node_phase("retrieve", node_migrator):
+                    node_migrator.retrieve_old_data()
+                # The pool estimated the node before its old data was read
+                node_migrator.db_acquire(False)
+                node_migrator.db_release()
+        else:
+            with self.profiler.phase("parallel generate", self.nodes):
+                self.generate_nodes_in_parallel(pending_nodes)
 
-        print()
-        for channel in channels.values():
-            channel.generate_channels()
-        for channel in channels.values():
-            channel.generate_trust_lines()
+        with self.profiler.phase("channels", self.nodes):
+            channels = NodeChannel.construct_channels(self.nodes)
+            self.channels = channels
 
-        print()
-        for node_migrator in self.nodes.values():
-            node_migrator.retrieve_own_keys()
             print()
+            for channel in channels.values():
+                channel.generate_channels()
+        self.log_phase_counters("channels")
+        with self.profiler.phase("trust lines", self.nodes):
+            for channel in channels.values():
+                channel.generate_trust_lines()
+        self.log_phase_counters("trust lines")
 
         self.save()
-
-        #exit(0)
         self.resume()
 
+    def generate_nodes_in_parallel(self, pending_nodes):
+        print("Generating " + str(len(pending_nodes)) + " nodes using " + str(self.jobs) + " processes...")
+        if self.in_memory:
+            for node_migrator in pending_nodes:
+                node_migrator.db_disconnect(False)
+
+        # Workers are forked, so they share this context without pickling it
+        pool_context = multiprocessing.get_context("fork")
+        with pool_context.Pool(self.jobs, NodeMigrator.init_worker, (self,)) as pool:
+            for node_migrator in pool.imap(NodeMigrator.generate_worker, pending_nodes):
+                node_migrator.ctx = self
+                self.profiler.add_node(node_migrator, ("generate", "retrieve"))
+                if self.in_memory:
+                    node_migrator.db_connect(False)
+                self.nodes[node_migrator.node_name] = node_migrator
+                node_migrator.db_acquire(False)
+
     def resume(self):
-        for channel in self.channels.values():
-            channel.generate_contractor_keys()
+        print()
+        for node_migrator in self.nodes.values():
+            if self.journal.is_node_done("own_keys", node_migrator.node_name):
+                continue
+            with self.profiler.node_phase("own keys", node_migrator):
+                node_migrator.retrieve_own_keys()
+            self.journal.mark_node("own_keys", node_migrator.node_name)
             print()
 
+        if not self.journal.is_phase_done("contractor_keys"):
+            with self.profiler.phase("contractor keys", self.nodes):
+                if self.resumed:
+                    # Keys written by an interrupted attempt would collide with the regenerated ones
+                    for node_migrator in self.nodes.values():
+                        node_migrator.clear_contractor_keys()
+                for channel in self.channels.values():
+                    channel.generate_contractor_keys()
+            self.log_phase_counters("contractor keys")
+            self.checkpoint("contractor_keys")
+
         for node_migrator in self.nodes.values():
-            node_migrator.hash_audits()
+            if self.journal.is_node_done("hash_audits", node_migrator.node_name):
+                node_migrator.load_audits()
+                continue
+            with self.profiler.node_phase("audits", node_migrator):
+                node_migrator.hash_audits()
+            self.journal.mark_node("hash_audits", node_migrator.node_name)
             print()
 
-        for channel in self.channels.values():
-            channel.generate_audit_crypto()
-            print()
+        if not self.journal.is_phase_done("audit_crypto"):
+            with self.profiler.phase("audit crypto", self.nodes):
+                for channel in self.channels.values():
+                    channel.generate_audit_crypto()
+            self.log_phase_counters("audit crypto")
+            self.checkpoint("audit_crypto")
 
         for node_migrator in self.nodes.values():
-            node_migrator.migrate()
+            if self.journal.is_node_done("migrate", node_migrator.node_name):
+                continue
+            with self.profiler.node_phase("history", node_migrator):
+                node_migrator.migrate()
+            self.journal.mark_node("migrate", node_migrator.node_name)
 
         if self.migration_error_json is not None:
             print("THERE ARE ERRORS!!")
@@ -125,6 +208,63 @@ class Main(context.Context):
             with open(migration_error_file_path, 'w') as cpm_file_out:
                 json.dump(self.migration_error_json, cpm_file_out, sort_keys=True, indent=4, ensure_ascii=False)
 
+        if self.connection_pool is not None:
+            self.connection_pool.close()
+        self.save_profile()
+        self.journal.remove()
+
+    def save_profile(self):
+        self.profiler.log_summary()
+        print("Saving '" + self.profile_path + "' file...")
+        self.save_json(self.profiler.report(self.nodes.values(), self.resumed, self.jobs), self.profile_path)
+
+    def commit(self):
+        # Everything written so far has to be committed before a phase is journaled
+        if self.connection_pool is not None:
+            self.connection_pool.release_all()
+        elif self.in_memory:
+            for node_migrator in self.nodes.values():
+                node_migrator.new_storage_con.commit()
+
+    def checkpoint(self, phase):
+        self.commit()
+        self.journal.mark_phase(phase)
+
+    def save(self):
+        self.commit()
+        self.journal.save_snapshot(
+            {
+                "gns_addresses": self.gns_addresses,
+                "new_equivalents": self.new_equivalents,
+                "migration_error_json": self.migration_error_json
+            },
+            self.nodes.values(),
+            self.channels.values()
+        )
+
+    def load(self):
+        if self.restart or not self.journal.load():
+            return False
+        context_state = self.journal.context_state
+        self.gns_addresses = context_state["gns_addresses"]
+        self.new_equivalents = context_state["new_equivalents"]
+        self.migration_error_json = context_state["migration_error_json"]
+
+        for node_name, node_state in self.journal.node_states.items():
+            node_migrator = NodeMigrator.from_checkpoint_state(self, node_state)
+            self.nodes[node_name] = node_migrator
+            node_migrator.db_acquire(False)
+        self.journal.node_states.clear()
+
+        self.channels = dict()
+        for node_name1, node_name2, id_on_contractor_side1, id_on_contractor_side2 in self.journal.channels:
+            channel = NodeChannel(self.nodes[node_name1], self.nodes[node_name2])
+            channel.id_on_contractor_side1 = id_on_contractor_side1
+            channel.id_on_contractor_side2 = id_on_contractor_side2
+            self.channels[NodeChannel.construct_contractor_tuple(node_name1, node_name2)] = channel
+        self.resumed = True
+        return True
+
     @staticmethod
     def increment_node_address(node_address):
         if node_address is None:
@@ -136,21 +276,33 @@ class Main(context.Context):
     @staticmethod
     def usage():
         print("Usage:")
-        print("\tpython migrate.py [-v] [-m] [-a address] [-o observers]")
+        print("\tpython migrate.py [-v] [-m] [-j jobs] [--history-batch rows] [--stream-history]"
+              " [--open-nodes count] [--memory-budget size] [--restart] [--profile path] [-a address] [-o observers]")
         print("Example:")
         print("\tpython migrate.py -o 127.0.0.1:4000,127.0.0.1:4001,127.0.0.1:4002")
         print("\tNote: -v is verbose output")
         print("\tNote: -m is 'in_memory' mode (Faster but high RAM usage!!)")
+        print("\tNote: -j is number of processes used to generate nodes and read their old data")
+        print("\tNote: --history-batch is number of history rows written per executemany (default 10000)")
+        print("\tNote: --stream-history reads old history only while migrating it, one batch at a time")
+        print("\tNote: --open-nodes is number of nodes whose storages are kept open between calls "
+              "when not in 'in_memory' mode (default 64, 0 reopens them on every call)")
+        print("\tNote: --memory-budget (e.g. 512M, 4G) bounds open storages and cached node data, "
+              "least recently used nodes are spilled to disk")
+        print("\tNote: an interrupted migration is resumed from its last completed phase, "
+              "--restart starts it over")
+        print("\tNote: --profile is path of the JSON report with wall and CPU time, storage rows read and written "
+              "and peak RSS of every phase and node (default 'migration_profile.json' in new infrastructure)")
 
 
 if __name__ == "__main__":
     start_time = time.time()
-    main = Main.load()
-    if main is None:
-        Main().migrate()
-    else:
+    main = Main()
+    if main.load():
         print("Migration is Resumed!!")
         main.resume()
+    else:
+        main.migrate()
     hours, rem = divmod(time.time() - start_time, 3600)
     minutes, seconds = divmod(rem, 60)
     print("Finished in {:0>2}:{:0>2}:{:05.2f}".format(int(hours), int(minutes), seconds))
@@ -15,9 +15,10 @@ class NodeChannel:
         self.id_on_contractor_side1 = self.node2.channel_idx
         self.id_on_contractor_side2 = self.node1.channel_idx
 
-        print("Generating channel(" +
-              str(self.id_on_contractor_side2) + ":" + str(self.id_on_contractor_side1) +
-              ") between nodes: " + self.node1.node_name + ", " + self.node2.node_name)
+        self.node1.ctx.logger.debug(
+            "Generating channel(%s:%s) between nodes: %s, %s",
+            self.id_on_contractor_side2, self.id_on_contractor_side1, self.node1.node_name, self.node2.node_name)
+        self.node1.ctx.count_records("channels", "channels")
 
         self.node1.add_channel(
             pk1, sk1, pk2,
@@ -31,9 +32,8 @@ class NodeChannel:
         )
 
     def generate_trust_lines(self):
-        print()
-        print("Generating trust lines between nodes: " +
-              self.node1.node_name + ", " + self.node2.node_name)
+        self.node1.ctx.logger.debug(
+            "Generating trust lines between nodes: %s, %s", self.node1.node_name, self.node2.node_name)
 
         self.node1.add_trust_lines(
             self.id_on_contractor_side2,
@@ -45,73 +45,44 @@ class NodeChannel:
         )
 
     def generate_contractor_keys(self):
-        print("Generating contractor keys between nodes: " +
-              self.node1.node_name + ", " + self.node2.node_name)
+        logger = self.node1.ctx.logger
+        logger.debug("Generating contractor keys between nodes: %s, %s", self.node1.node_name, self.node2.node_name)
+        contractor_keys_count = 0
 
-        if not self.node1.ctx.in_memory:
-            self.node1.db_connect(False)
-        if not self.node2.ctx.in_memory:
-            self.node2.db_connect(False)
-
-        for trust_line1 in self.node1.trust_lines.values():
-            if trust_line1.contractor_id != self.id_on_contractor_side2:
-                continue
-            channel1 = self.node1.channels.get(trust_line1.contractor_id, None)
-            channel2 = self.node2.channels.get(channel1.id_on_contractor_side, None)
+        self.node1.db_acquire()
+        self.node2.db_acquire()
 
+        for trust_line1, trust_lines2 in self.pair_trust_lines():
             own_keys1 = self.node1.load_own_keys(trust_line1.id)
-            for trust_line2 in self.node2.trust_lines.values():
-                if trust_line2.contractor_id != self.id_on_contractor_side1:
-                    continue
-                if trust_line2.contractor_id != channel2.id or \
-                        trust_line1.equivalent != trust_line2.equivalent:
-                    continue
-
-                print(
-                    "\tGenerating contractor keys for trust lines" +
-                    "(" + str(trust_line1.id) + ":" + str(trust_line2.id) + ")"
-                )
+            for trust_line2 in trust_lines2:
+                logger.debug("\tGenerating contractor keys for trust lines(%s:%s)", trust_line1.id, trust_line2.id)
                 own_keys2 = self.node2.load_own_keys(trust_line2.id)
-                for own_key1 in own_keys1:
-                    if own_key1.trust_line_id != trust_line1.id:
-                        continue
-                    for own_key2 in own_keys2:
-                        if own_key2.trust_line_id != trust_line2.id or \
-                                own_key1.number != own_key2.number:
-                            continue
-                        self.node1.add_contractor_key(
-                            own_key1,
-                            own_key2
-                        )
-                        self.node2.add_contractor_key(
-                            own_key2,
-                            own_key1
-                        )
-
-        if not self.node1.ctx.in_memory:
-            self.node1.db_disconnect(False)
-        if not self.node2.ctx.in_memory:
-            self.node2.db_disconnect(False)
+                for own_key1, own_key2 in self.match_own_keys(trust_line1, own_keys1, trust_line2, own_keys2):
+                    self.node1.add_contractor_key(
+                        own_key1,
+                        own_key2
+                    )
+                    self.node2.add_contractor_key(
+                        own_key2,
+                        own_key1
+                    )
+                    contractor_keys_count += 2
+
+        self.node1.db_release()
+        self.node2.db_release()
+        self.node1.ctx.count_records("contractor keys", "contractor keys", contractor_keys_count)
 
     def generate_audit_crypto(self):
-        print("Generating audit hashes and signatures between nodes: " +
-              self.node1.node_name + ", " + self.node2.node_name)
-
-        for trust_line1 in self.node1.trust_lines.values():
-            if trust_line1.contractor_id != self.id_on_contractor_side2:
-                continue
-            channel1 = self.node1.channels.get(trust_line1.contractor_id, None)
-            channel2 = self.node2.channels.get(channel1.id_on_contractor_side, None)
-
-            for trust_line2 in self.node2.trust_lines.values():
-                if trust_line2.contractor_id != self.id_on_contractor_side1:
-                    continue
-                if trust_line2.contractor_id != channel2.id or \
-                        trust_line1.equivalent != trust_line2.equivalent:
-                    continue
-
-                print("\tGenerating audit(" +
-                      str(trust_line1.id) + ":" + str(trust_line2.id) + ")")
+        logger = self.node1.ctx.logger
+        logger.debug(
+            "Generating audit hashes and signatures between nodes: %s, %s", self.node1.node_name, self.node2.node_name)
+        audits_count = 0
+
+        self.node1.db_acquire(False)
+        self.node2.db_acquire(False)
+        for trust_line1, trust_lines2 in self.pair_trust_lines():
+            for trust_line2 in trust_lines2:
+                logger.debug("\tGenerating audit(%s:%s)", trust_line1.id, trust_line2.id)
                 self.node1.update_audit_crypto(
                     trust_line1.id,
                     trust_line2.our_key_hash,
@@ -122,11 +93,35 @@ class NodeChannel:
                     trust_line1.our_key_hash,
                     trust_line1.our_signature
                 )
+                audits_count += 2
+        self.node1.ctx.count_records("audit crypto", "audits", audits_count)
+
+    def pair_trust_lines(self):
+        # Yields node1's trust lines to node2 together with node2's trust lines of the same equivalent,
+        # looked up in the per-contractor indexes instead of scanning all trust lines of both nodes
+        for trust_line1 in self.node1.trust_lines_by_contractor.get(self.id_on_contractor_side2, []):
+            channel1 = self.node1.channels.get(trust_line1.contractor_id, None)
+            channel2 = self.node2.channels.get(channel1.id_on_contractor_side, None)
+            if channel2.id != self.id_on_contractor_side1:
+                continue
+            yield trust_line1, self.node2.trust_lines_by_equivalent.get((channel2.id, trust_line1.equivalent), [])
+
+    @staticmethod
+    def match_own_keys(trust_line1, own_keys1, trust_line2, own_keys2):
+        own_keys2_index = dict()
+        for own_key2 in own_keys2:
+            own_keys2_index.setdefault((own_key2.trust_line_id, own_key2.number), []).append(own_key2)
+        for own_key1 in own_keys1:
+            if own_key1.trust_line_id != trust_line1.id:
+                continue
+            for own_key2 in own_keys2_index.get((trust_line2.id, own_key1.number), []):
+                yield own_key1, own_key2
 
     @staticmethod
     def construct_channels(nodes):
         channels = dict()
         for node_migrator in nodes.values():
+            node_migrator.db_acquire(False)
             for trust_line in node_migrator.old_trust_lines:
                 contractor_tuple = NodeChannel.construct_contractor_tuple(
                     node_migrator.node_name, trust_line.contractor_id)
@@ -1,8 +1,8 @@
 import json
 import os
-import threading
-import time
+import struct
 
+from node import responses
 from node.executor import NodeExecutor
 
 
@@ -10,6 +10,15 @@ class NodeComparator(NodeExecutor):
     def __init__(self, ctx, node_name, old_node_path, new_node_path, old_client_path, new_client_path, old_uuid_2_address_path):
         super().__init__(ctx, node_name, old_node_path, new_node_path, old_client_path, new_client_path, old_uuid_2_address_path)
 
+    def count_history_rows(self):
+        self.db_connect(False)
+        self.old_storage_cur.execute(
+            "SELECT COUNT(*) "
+            "FROM history;")
+        rows = self.old_storage_cur.fetchall()
+        self.db_disconnect(False)
+        return rows[0][0]
+
     def compare(self):
         compared_file_path = os.path.join(self.new_node_path, "compared.json")
         if os.path.isfile(compared_file_path):
@@ -18,76 +27,101 @@ class NodeComparator(NodeExecutor):
         print()
         print("Comparing node #"+str(self.node_idx+1)+": " + self.node_name)
 
-        self.retrieve_data_from_old_node()
-        self.retrieve_data_from_new_node()
+        if self.ctx.offline:
+            old_json_node, old_json_ignored_node = self.retrieve_data_from_old_storage()
+            new_json_node, new_json_ignored_node = self.retrieve_data_from_new_storage()
+        else:
+            old_json_node, old_json_ignored_node = self.retrieve_data_from_old_node()
+            new_json_node = self.retrieve_data_from_new_node()
+            new_json_ignored_node = {}
 
+        # Results are stored before the node is marked as compared
+        self.ctx.save_node_comparision(
+            self.node_name, old_json_node, old_json_ignored_node, new_json_node, new_json_ignored_node)
         with open(compared_file_path, 'w') as cpm_file_out:
             json.dump({}, cpm_file_out, sort_keys=True, indent=4, ensure_ascii=False)
-        self.ctx.save_comparision_files()
         self.ctx.nodes_count_processed += 1
 
-    def clear(self, node_handle):
-        node_handle.terminate()
-        self.clean()
+    # Trust lines, trust lines history and payments history of an equivalent, requested page by page
+    PAGED_COMMANDS = (
+        'GET:contractors/trust-lines\t{offset}\t{count}\t{eq}\n',
+        'GET:history/trust-lines\t{offset}\t{count}\tnull\tnull\t{eq}\n',
+        'GET:history/payments\t{offset}\t{count}\tnull\tnull\tnull\tnull\tnull\t{eq}\n',
+    )
+
+    def retrieve_pages(self, commands_fifo_path, equivalents, parsers):
+        # The first pages of all equivalents are pipelined together, then the next pages of those
+        # that filled their page. Every page is parsed as soon as it arrives and let go, so at most
+        # one page per command is held, however long the history of the node is.
+        page_size = self.ctx.history_page_size
+        pending_pages = [(c, eq, 0) for eq in equivalents for c in range(len(self.PAGED_COMMANDS))]
+        while len(pending_pages) > 0:
+            results = self.run_commands(commands_fifo_path, [
+                self.PAGED_COMMANDS[c].format(offset=offset, count=page_size, eq=eq)
+                for c, eq, offset in pending_pages])
+            next_pages = []
+            for p, (c, eq, offset) in enumerate(pending_pages):
+                if c == 0 and offset == 0:
+                    self.ctx.logger.debug("\tResults for equivalent %s:", eq)
+                elif offset > 0:
+                    self.ctx.logger.debug("\tResults for equivalent %s from %s:", eq, offset)
+                records_count = parsers[c](results[p], eq)
+                results[p] = None
+                if records_count >= page_size:
+                    next_pages.append((c, eq, offset + records_count))
+            pending_pages = next_pages
+
+    def clear(self, node_handle, node_path, result_fifo_path):
+        # A node is compared once, so its processes are not kept running
+        self.release_node(node_handle, node_path, result_fifo_path, False)
+
+    def prestart_old_node(self):
+        # Only the old client is started ahead: the new one usually listens on the same address
+        # (migrated without -a, or gns on the old port), so it is started once the old one is stopped
+        self.ctx.node_supervisor.prestart(
+            self, self.old_node_path, self.old_client_path, self.old_commands_fifo_path, self.old_result_fifo_path)
 
     def retrieve_data_from_old_node(self):
         print("Process old node...")
         commands_fifo_path = self.old_commands_fifo_path
 
-        old_node_result_fifo_thread =\
-            threading.Thread(target=self.open_node_result_fifo, args=(self.old_result_fifo_path,))
-        old_node_result_fifo_thread.start()
+        node_handle = self.acquire_node(
+            self.old_node_path, self.old_client_path, commands_fifo_path, self.old_result_fifo_path)
 
-        node_handle = self.run_node(self.old_node_path, self.old_client_path, True, False)
-
-        self.ctx.old_comparision_json[self.node_name] = {}
-        json_node = self.ctx.old_comparision_json[self.node_name]
-
-        self.ctx.old_ignored_json[self.node_name] = {}
-        json_ignored_node = self.ctx.old_ignored_json[self.node_name]
+        json_node = {}
+        json_ignored_node = {}
 
         try:
-            time.sleep(0.2)
             print("Requesting equivalents...")
             result_eq = self.run_command(
                 commands_fifo_path,
-                '13e5cf8c-5834-4e52-b65b-f9281dd1ff91\tGET:equivalents\n').decode("utf-8")
-            result_eq = result_eq.split('\t')
-            eq_count = int(result_eq[2])
-            print("Found " + str(eq_count) + " equivalents")
-            for e in range(eq_count):
-                eq = int(result_eq[e + 3])
-                self.retrieve_tl_from_old_node(commands_fifo_path, json_node, eq)
-                self.retrieve_h_tl_from_old_node(commands_fifo_path, json_node, json_ignored_node, eq)
-                self.retrieve_h_p_from_old_node(commands_fifo_path, json_node, json_ignored_node, eq)
+                '13e5cf8c-5834-4e52-b65b-f9281dd1ff91\tGET:equivalents\n')
+            equivalents = [int(eq) for eq in responses.decode_values(result_eq)]
+            print("Found " + str(len(equivalents)) + " equivalents")
+            print("Requesting trust lines and history for all equivalents...")
+            self.retrieve_pages(commands_fifo_path, equivalents, (
+                lambda result, eq: self.retrieve_tl_from_old_node(result, json_node, eq),
+                lambda result, eq: self.retrieve_h_tl_from_old_node(result, json_node, json_ignored_node, eq),
+                lambda result, eq: self.retrieve_h_p_from_old_node(result, json_node, json_ignored_node, eq)))
         except Exception as e:
             print(e)
-            self.clear(node_handle)
+            self.clear(node_handle, self.old_node_path, self.old_result_fifo_path)
             assert False, "Reassert "
 
-        self.clear(node_handle)
+        self.clear(node_handle, self.old_node_path, self.old_result_fifo_path)
+        return json_node, json_ignored_node
 
-    def retrieve_tl_from_old_node(self, commands_fifo_path, json_node, eq):
-        print("\tRequesting trust lines for equivalent " + str(eq) + "...")
-        result_tl = self.run_command(
-            commands_fifo_path,
-            '13e5cf8c-5834-4e52-b65b-f9281dd1ff91\tGET:contractors/trust-lines\t0\t100000\t'+str(eq)+'\n').\
-            decode("utf-8")
-        result_tl = result_tl.split('\t')
-        tl_count = int(result_tl[2])
+    def retrieve_tl_from_old_node(self, result_tl, json_node, eq):
+        trust_lines = responses.OLD_TRUST_LINES.decode(result_tl)
         eq = self.ctx.eq_map(eq)
-        print("\tFound " + str(tl_count) + " trust lines")
-        for t in range(tl_count):
-            trust_line_array_shift = t * 4 + 3
-            contractor_id = result_tl[trust_line_array_shift + 0]
-            incoming_trust_amount = float(result_tl[trust_line_array_shift + 1])
-            outgoing_trust_amount = float(result_tl[trust_line_array_shift + 2])
-            balance = float(result_tl[trust_line_array_shift + 3])
-            print("\t\tTrust line " + str(t+1) + ":" +
-                  " id="+str(contractor_id) + ";" +
-                  " incoming=" + str(incoming_trust_amount) + ";" +
-                  " outgoing=" + str(outgoing_trust_amount) + ";" +
-                  " balance=" + str(balance))
+        self.ctx.logger.debug("\tFound %s trust lines", trust_lines.count)
+        self.ctx.count_records("compare", "old trust lines", trust_lines.count)
+        for t, (contractor_id, incoming_trust_amount, outgoing_trust_amount, balance) in enumerate(zip(
+                trust_lines.contractor_id, trust_lines.incoming_trust_amount,
+                trust_lines.outgoing_trust_amount, trust_lines.balance)):
+            self.ctx.logger.debug(
+                "\t\tTrust line %s: id=%s; incoming=%s; outgoing=%s; balance=%s",
+                t + 1, contractor_id, incoming_trust_amount, outgoing_trust_amount, balance)
             json_node["tl_"+str(eq)+","+contractor_id] = {
                 "equivalent": eq,
                 "contractor_id": contractor_id,
@@ -95,27 +129,20 @@ class NodeComparator(NodeExecutor):
                 "outgoing_trust_amount": outgoing_trust_amount,
                 "balance": balance
             }
+        return trust_lines.count
 
-    def retrieve_h_tl_from_old_node(self, commands_fifo_path, json_node, json_ignored_node, eq):
-        print("\tRequesting history trust lines for equivalent " + str(eq) + "...")
-        result_tl = self.run_command(
-            commands_fifo_path,
-            '13e5cf8c-5834-4e52-b65b-f9281dd1ff91\tGET:history/trust-lines\t0\t100000\tnull\tnull\t'+str(eq)+'\n').\
-            decode("utf-8")
-        result_tl = result_tl.split('\t')
-        tl_count = int(result_tl[2])
+    def retrieve_h_tl_from_old_node(self, result_tl, json_node, json_ignored_node, eq):
+        history = responses.HISTORY_TRUST_LINES.decode(result_tl)
         eq = self.ctx.eq_map(eq)
-        print("\tFound " + str(tl_count) + " history trust lines")
-        for t in range(tl_count):
-            trust_line_array_shift = t * 5 + 3
-            transaction_uuid = result_tl[trust_line_array_shift + 0]
-            timestamp = int(result_tl[trust_line_array_shift + 1])
-            addresses = result_tl[trust_line_array_shift + 2]
-            operation_type = result_tl[trust_line_array_shift + 3]
-            summ = float(result_tl[trust_line_array_shift + 4])
+        self.ctx.logger.debug("\tFound %s history trust lines", history.count)
+        self.ctx.count_records("compare", "old history trust lines", history.count)
+        for t, (transaction_uuid, timestamp, addresses, operation_type, summ) in enumerate(zip(
+                history.transaction_uuid, history.timestamp, history.addresses,
+                history.operation_type, history.sum)):
             node = self.ctx.nodes.get(addresses)
             if node is None:
-                print("\t\tHistory tl " + str(t+1) + " Ignore unknown node " + addresses)
+                self.ctx.logger.debug("\t\tHistory tl %s Ignore unknown node %s", t + 1, addresses)
+                self.ctx.count_records("compare", "old ignored history records")
                 json_ignored_node["h_tl_"+str(eq)+","+transaction_uuid] = {
                     "equivalent": eq,
                     "transaction_uuid": transaction_uuid,
@@ -125,11 +152,9 @@ class NodeComparator(NodeExecutor):
                     "sum": summ
                 }
                 continue
-            print("\t\tHistory tl " + str(t+1) + ":" +
-                  " id="+str(transaction_uuid) + ";" +
-                  " timestamp=" + str(timestamp) + ";" +
-                  " type=" + str(operation_type) + ";" +
-                  " summ=" + str(summ))
+            self.ctx.logger.debug(
+                "\t\tHistory tl %s: id=%s; timestamp=%s; type=%s; summ=%s",
+                t + 1, transaction_uuid, timestamp, operation_type, summ)
             json_node["h_tl_"+str(eq)+","+transaction_uuid] = {
                 "equivalent": eq,
                 "transaction_uuid": transaction_uuid,
@@ -138,30 +163,20 @@ class NodeComparator(NodeExecutor):
                 "operation_type": operation_type,
                 "sum": summ
             }
+        return history.count
 
-    def retrieve_h_p_from_old_node(self, commands_fifo_path, json_node, json_ignored_node, eq):
-        print("\tRequesting history payments for equivalent " + str(eq) + "...")
-        result_tl = self.run_command(
-            commands_fifo_path,
-            '13e5cf8c-5834-4e52-b65b-f9281dd1ff91\tGET:history/payments\t0\t100000\tnull\tnull\tnull\tnull\tnull\t' +
-            str(eq) + '\n'). \
-            decode("utf-8")
-        #print('Result: "{0}"'.format(result_tl))
-        result_tl = result_tl.split('\t')
-        tl_count = int(result_tl[2])
+    def retrieve_h_p_from_old_node(self, result_tl, json_node, json_ignored_node, eq):
+        history = responses.OLD_HISTORY_PAYMENTS.decode(result_tl)
         eq = self.ctx.eq_map(eq)
-        print("\tFound " + str(tl_count) + " history payments")
-        for t in range(tl_count):
-            trust_line_array_shift = t * 6 + 3
-            transaction_uuid = result_tl[trust_line_array_shift + 0]
-            timestamp = int(result_tl[trust_line_array_shift + 1])
-            addresses = result_tl[trust_line_array_shift + 2]
-            payment_type = result_tl[trust_line_array_shift + 3]
-            summ = float(result_tl[trust_line_array_shift + 4])
-            balance = float(result_tl[trust_line_array_shift + 5])
+        self.ctx.logger.debug("\tFound %s history payments", history.count)
+        self.ctx.count_records("compare", "old history payments", history.count)
+        for t, (transaction_uuid, timestamp, addresses, payment_type, summ, balance) in enumerate(zip(
+                history.transaction_uuid, history.timestamp, history.addresses,
+                history.payment_type, history.sum, history.balance)):
             node = self.ctx.nodes.get(addresses)
             if node is None:
-                print("\t\tHistory p " + str(t+1) + " Ignore unknown node " + addresses)
+                self.ctx.logger.debug("\t\tHistory p %s Ignore unknown node %s", t + 1, addresses)
+                self.ctx.count_records("compare", "old ignored history records")
                 json_ignored_node["h_p_"+str(eq)+","+transaction_uuid] = {
                     "equivalent": eq,
                     "transaction_uuid": transaction_uuid,
@@ -172,12 +187,9 @@ class NodeComparator(NodeExecutor):
                     "balance": balance
                 }
                 continue
-            print("\t\tHistory p " + str(t+1) + ":" +
-                  " id="+str(transaction_uuid) + ";" +
-                  " timestamp=" + str(timestamp) + ";" +
-                  " type=" + str(payment_type) + ";" +
-                  " summ=" + str(summ) + ";" +
-                  " balance=" + str(balance))
+            self.ctx.logger.debug(
+                "\t\tHistory p %s: id=%s; timestamp=%s; type=%s; summ=%s; balance=%s",
+                t + 1, transaction_uuid, timestamp, payment_type, summ, balance)
             json_node["h_p_"+str(eq)+","+transaction_uuid] = {
                 "equivalent": eq,
                 "transaction_uuid": transaction_uuid,
@@ -187,69 +199,55 @@ class NodeComparator(NodeExecutor):
                 "sum": summ,
                 "balance": balance
             }
+        return history.count
 
     def retrieve_data_from_new_node(self):
         print("Process new node...")
         commands_fifo_path = self.new_commands_fifo_path
 
-        new_node_result_fifo_thread =\
-            threading.Thread(target=self.open_node_result_fifo,args=(self.new_result_fifo_path,))
-        new_node_result_fifo_thread.start()
-
-        node_handle = self.run_node(self.new_node_path, self.new_client_path, True, False)
+        node_handle = self.acquire_node(
+            self.new_node_path, self.new_client_path, commands_fifo_path, self.new_result_fifo_path)
 
-        self.ctx.new_comparision_json[self.node_name] = {}
-        json_node = self.ctx.new_comparision_json[self.node_name]
+        json_node = {}
 
         try:
-            time.sleep(0.2)
             print("Requesting equivalents...")
             result_eq = self.run_command(
                 commands_fifo_path,
-                '13e5cf8c-5834-4e52-b65b-f9281dd1ff91\tGET:equivalents\n').decode("utf-8")
-            result_eq = result_eq.split('\t')
-            eq_count = int(result_eq[2])
-            print("Found " + str(eq_count) + " equivalents")
-            for e in range(eq_count):
-                eq = int(result_eq[e + 3])
-                self.retrieve_tl_from_new_node(commands_fifo_path, json_node, eq)
-                self.retrieve_h_tl_from_new_node(commands_fifo_path, json_node, eq)
-                self.retrieve_h_p_from_new_node(commands_fifo_path, json_node, eq)
+                '13e5cf8c-5834-4e52-b65b-f9281dd1ff91\tGET:equivalents\n')
+            equivalents = [int(eq) for eq in responses.decode_values(result_eq)]
+            print("Found " + str(len(equivalents)) + " equivalents")
+            print("Requesting trust lines and history for all equivalents...")
+            self.retrieve_pages(commands_fifo_path, equivalents, (
+                lambda result, eq: self.retrieve_tl_from_new_node(result, json_node, eq),
+                lambda result, eq: self.retrieve_h_tl_from_new_node(result, json_node, eq),
+                lambda result, eq: self.retrieve_h_p_from_new_node(result, json_node, eq)))
         except Exception as e:
             print(e)
-            self.clear(node_handle)
+            self.clear(node_handle, self.new_node_path, self.new_result_fifo_path)
             assert False, "Reassert "
 
-        self.clear(node_handle)
-
-    def retrieve_tl_from_new_node(self, commands_fifo_path, json_node, eq):
-        print("\tRequesting trust lines for equivalent " + str(eq) + "...")
-        result_tl = self.run_command(
-            commands_fifo_path,
-            '13e5cf8c-5834-4e52-b65b-f9281dd1ff91\tGET:contractors/trust-lines\t0\t100000\t'+str(eq)+'\n').\
-            decode("utf-8")
-        result_tl = result_tl.split('\t')
-        tl_count = int(result_tl[2])
-        print("\tFound " + str(tl_count) + " trust lines")
-        for t in range(tl_count):
-            trust_line_array_shift = t * 8 + 3
-            contractor_id = int(result_tl[trust_line_array_shift + 0])
-            addresses = result_tl[trust_line_array_shift + 1]
-            state = int(result_tl[trust_line_array_shift + 2])
-            own_keys = int(result_tl[trust_line_array_shift + 3])
-            contractor_keys = int(result_tl[trust_line_array_shift + 4])
-            incoming_trust_amount = float(result_tl[trust_line_array_shift + 5])
-            outgoing_trust_amount = float(result_tl[trust_line_array_shift + 6])
-            balance = float(result_tl[trust_line_array_shift + 7])
-            address = addresses[addresses.find(' ')+1:]
-            node = self.ctx.nodes_by_address.get(address)
-            if node is None:
-                assert False, "Can't find node by address " + address
-            print("\t\tTrust line " + str(t+1) + ":" +
-                  " id="+str(node.node_name) + ";" +
-                  " incoming=" + str(incoming_trust_amount) + ";" +
-                  " outgoing=" + str(outgoing_trust_amount) + ";" +
-                  " balance=" + str(balance))
+        self.clear(node_handle, self.new_node_path, self.new_result_fifo_path)
+        return json_node
+
+    def node_by_address(self, addresses):
+        address = addresses[addresses.find(' ')+1:]
+        node = self.ctx.nodes_by_address.get(address)
+        if node is None:
+            assert False, "Can't find node by address " + address
+        return node
+
+    def retrieve_tl_from_new_node(self, result_tl, json_node, eq):
+        trust_lines = responses.NEW_TRUST_LINES.decode(result_tl)
+        self.ctx.logger.debug("\tFound %s trust lines", trust_lines.count)
+        self.ctx.count_records("compare", "new trust lines", trust_lines.count)
+        for t, (addresses, incoming_trust_amount, outgoing_trust_amount, balance) in enumerate(zip(
+                trust_lines.addresses, trust_lines.incoming_trust_amount,
+                trust_lines.outgoing_trust_amount, trust_lines.balance)):
+            node = self.node_by_address(addresses)
+            self.ctx.logger.debug(
+                "\t\tTrust line %s: id=%s; incoming=%s; outgoing=%s; balance=%s",
+                t + 1, node.node_name, incoming_trust_amount, outgoing_trust_amount, balance)
             json_node["tl_"+str(eq)+","+node.node_name] = {
                 "equivalent": eq,
                 "contractor_id": node.node_name,
@@ -257,32 +255,19 @@ class NodeComparator(NodeExecutor):
                 "outgoing_trust_amount": outgoing_trust_amount,
                 "balance": balance
             }
+        return trust_lines.count
 
-    def retrieve_h_tl_from_new_node(self, commands_fifo_path, json_node, eq):
-        print("\tRequesting history trust lines for equivalent " + str(eq) + "...")
-        result_tl = self.run_command(
-            commands_fifo_path,
-            '13e5cf8c-5834-4e52-b65b-f9281dd1ff91\tGET:history/trust-lines\t0\t100000\tnull\tnull\t'+str(eq)+'\n').\
-            decode("utf-8")
-        result_tl = result_tl.split('\t')
-        tl_count = int(result_tl[2])
-        print("\tFound " + str(tl_count) + " history trust lines")
-        for t in range(tl_count):
-            trust_line_array_shift = t * 5 + 3
-            transaction_uuid = result_tl[trust_line_array_shift + 0]
-            timestamp = int(result_tl[trust_line_array_shift + 1])
-            addresses = result_tl[trust_line_array_shift + 2]
-            operation_type = result_tl[trust_line_array_shift + 3]
-            summ = float(result_tl[trust_line_array_shift + 4])
-            address = addresses[addresses.find(' ')+1:]
-            node = self.ctx.nodes_by_address.get(address)
-            if node is None:
-                assert False, "Can't find node by address " + address
-            print("\t\tHistory tl " + str(t+1) + ":" +
-                  " id="+str(transaction_uuid) + ";" +
-                  " timestamp=" + str(timestamp) + ";" +
-                  " type=" + str(operation_type) + ";" +
-                  " summ=" + str(summ))
+    def retrieve_h_tl_from_new_node(self, result_tl, json_node, eq):
+        history = responses.HISTORY_TRUST_LINES.decode(result_tl)
+        self.ctx.logger.debug("\tFound %s history trust lines", history.count)
+        self.ctx.count_records("compare", "new history trust lines", history.count)
+        for t, (transaction_uuid, timestamp, addresses, operation_type, summ) in enumerate(zip(
+                history.transaction_uuid, history.timestamp, history.addresses,
+                history.operation_type, history.sum)):
+            node = self.node_by_address(addresses)
+            self.ctx.logger.debug(
+                "\t\tHistory tl %s: id=%s; timestamp=%s; type=%s; summ=%s",
+                t + 1, transaction_uuid, timestamp, operation_type, summ)
             json_node["h_tl_"+str(eq)+","+transaction_uuid] = {
                 "equivalent": eq,
                 "transaction_uuid": transaction_uuid,
@@ -291,36 +276,19 @@ class NodeComparator(NodeExecutor):
                 "operation_type": operation_type,
                 "sum": summ
             }
+        return history.count
 
-    def retrieve_h_p_from_new_node(self, commands_fifo_path, json_node, eq):
-        print("\tRequesting history payments for equivalent " + str(eq) + "...")
-        result_tl = self.run_command(
-            commands_fifo_path,
-            '13e5cf8c-5834-4e52-b65b-f9281dd1ff91\tGET:history/payments\t0\t100000\tnull\tnull\tnull\tnull\tnull\t' +
-            str(eq) + '\n'). \
-            decode("utf-8")
-        #print('Result: "{0}"'.format(result_tl))
-        result_tl = result_tl.split('\t')
-        tl_count = int(result_tl[2])
-        print("\tFound " + str(tl_count) + " history payments")
-        for t in range(tl_count):
-            trust_line_array_shift = t * 7 + 3
-            transaction_uuid = result_tl[trust_line_array_shift + 0]
-            timestamp = int(result_tl[trust_line_array_shift + 1])
-            addresses = result_tl[trust_line_array_shift + 2]
-            payment_type = result_tl[trust_line_array_shift + 3]
-            summ = float(result_tl[trust_line_array_shift + 4])
-            balance = float(result_tl[trust_line_array_shift + 5])
-            address = addresses[addresses.find(' ')+1:]
-            node = self.ctx.nodes_by_address.get(address)
-            if node is None:
-                assert False, "Can't find node by address " + address
-            print("\t\tHistory p " + str(t+1) + ":" +
-                  " id="+str(transaction_uuid) + ";" +
-                  " timestamp=" + str(timestamp) + ";" +
-                  " type=" + str(payment_type) + ";" +
-                  " summ=" + str(summ) + ";" +
-                  " balance=" + str(balance))
+    def retrieve_h_p_from_new_node(self, result_tl, json_node, eq):
+        history = responses.NEW_HISTORY_PAYMENTS.decode(result_tl)
+        self.ctx.logger.debug("\tFound %s history payments", history.count)
+        self.ctx.count_records("compare", "new history payments", history.count)
+        for t, (transaction_uuid, timestamp, addresses, payment_type, summ, balance) in enumerate(zip(
+                history.transaction_uuid, history.timestamp, history.addresses,
+                history.payment_type, history.sum, history.balance)):
+            node = self.node_by_address(addresses)
+            self.ctx.logger.debug(
+                "\t\tHistory p %s: id=%s; timestamp=%s; type=%s; summ=%s; balance=%s",
+                t + 1, transaction_uuid, timestamp, payment_type, summ, balance)
             json_node["h_p_"+str(eq)+","+transaction_uuid] = {
                 "equivalent": eq,
                 "transaction_uuid": transaction_uuid,
@@ -330,3 +298,156 @@ class NodeComparator(NodeExecutor):
                 "sum": summ,
                 "balance": balance
             }
+        return history.count
+
+    # Offline comparision reads the same records straight from the storages, without the nodes.
+    # History record body: operation type, contractor (old: uuid, new: trust line contractor id
+    # for trust line records and the serialized address), then the amounts as the old node wrote them.
+    # The migrator appends a zero suffix to the new payment records.
+    TRUST_LINE_RECORD_TYPE = 1
+    PAYMENT_RECORD_TYPE = 2
+    PAYMENT_RECORD_SUFFIX_SIZE = 5
+    AMOUNT_SIZE = 32
+    BALANCE_SIZE = 33
+
+    @classmethod
+    def amount_value(cls, blob):
+        # Amounts are big-endian, a balance has one leading byte more for its sign
+        sign, amount = cls.read_amount(blob)
+        value = float(int(amount, 16)) if len(amount) > 0 else 0.0
+        return -value if sign == 1 else value
+
+    @staticmethod
+    def read_address(blob, pos=0):
+        # Serialized address as written by the migrator: ipv4 with port or gns name
+        address_type = blob[pos]
+        if address_type == 0x0c:
+            ip = '.'.join(str(byte) for byte in blob[pos + 1:pos + 5])
+            port = struct.unpack("H", blob[pos + 5:pos + 7])[0]
+            return ip + ":" + str(port), pos + 7
+        address_size = struct.unpack("H", blob[pos + 1:pos + 3])[0]
+        return blob[pos + 3:pos + 3 + address_size].decode(), pos + 3 + address_size
+
+    def history_record(self, row, eq, address, amounts):
+        operation_uuid, operation_timestamp, record_type, record_body = row
+        if record_type == self.TRUST_LINE_RECORD_TYPE:
+            return "h_tl_"+str(eq)+","+self.read_uuid(operation_uuid), {
+                "equivalent": eq,
+                "transaction_uuid": self.read_uuid(operation_uuid),
+                "timestamp": operation_timestamp,
+                "address": address,
+                "operation_type": str(record_body[0]),
+                "sum": self.amount_value(amounts[0:self.AMOUNT_SIZE])
+            }
+        return "h_p_"+str(eq)+","+self.read_uuid(operation_uuid), {
+            "equivalent": eq,
+            "transaction_uuid": self.read_uuid(operation_uuid),
+            "timestamp": operation_timestamp,
+            "address": address,
+            "payment_type": str(record_body[0]),
+            "sum": self.amount_value(amounts[0:self.AMOUNT_SIZE]),
+            "balance": self.amount_value(amounts[self.AMOUNT_SIZE:self.AMOUNT_SIZE + self.BALANCE_SIZE])
+        }
+
+    def retrieve_data_from_old_storage(self):
+        print("Reading old storage...")
+        json_node = {}
+        json_ignored_node = {}
+        self.db_connect(False)
+        try:
+            self.old_storage_cur.execute(
+                "SELECT contractor, incoming_amount, outgoing_amount, balance, equivalent "
+                "FROM trust_lines;")
+            for contractor, incoming_amount, outgoing_amount, balance, eq in self.old_storage_cur:
+                eq = self.ctx.eq_map(eq)
+                contractor_id = self.read_uuid(contractor)
+                json_node["tl_"+str(eq)+","+contractor_id] = {
+                    "equivalent": eq,
+                    "contractor_id": contractor_id,
+                    "incoming_trust_amount": self.amount_value(incoming_amount),
+                    "outgoing_trust_amount": self.amount_value(outgoing_amount),
+                    "balance": self.amount_value(balance)
+                }
+            trust_lines_count = len(json_node)
+
+            self.old_storage_cur.execute(
+                "SELECT operation_uuid, operation_timestamp, record_type, record_body, equivalent "
+                "FROM history "
+                "WHERE record_type IN (?, ?);",
+                (self.TRUST_LINE_RECORD_TYPE, self.PAYMENT_RECORD_TYPE))
+            for row in self.old_storage_cur:
+                record_body = row[3]
+                address = self.read_uuid(record_body[1:17])
+                key, record = self.history_record(row[:4], self.ctx.eq_map(row[4]), address, record_body[17:])
+                # Records of unknown nodes are not migrated as comparable
+                if self.ctx.nodes.get(address) is None:
+                    json_ignored_node[key] = record
+                else:
+                    json_node[key] = record
+        finally:
+            self.db_disconnect(False)
+        print("\tFound " + str(trust_lines_count) + " trust lines and " +
+              str(len(json_node) - trust_lines_count) + " history records, " +
+              str(len(json_ignored_node)) + " ignored")
+        self.ctx.count_records("compare", "old trust lines", trust_lines_count)
+        self.ctx.count_records("compare", "old history records", len(json_node) - trust_lines_count)
+        self.ctx.count_records("compare", "old ignored history records", len(json_ignored_node))
+        return json_node, json_ignored_node
+
+    def retrieve_data_from_new_storage(self):
+        print("Reading new storage...")
+        json_node = {}
+        json_ignored_node = {}
+        self.db_connect(False)
+        try:
+            # Amounts are those of the latest audit of every trust line
+            self.new_storage_cur.execute(
+                "SELECT t.equivalent, a.address, au.incoming_amount, au.outgoing_amount, au.balance "
+                "FROM trust_lines t "
+                "JOIN contractors_addresses a ON a.contractor_id = t.contractor_id "
+                "JOIN audit au ON au.trust_line_id = t.id "
+                "WHERE au.number = (SELECT MAX(number) FROM audit WHERE trust_line_id = t.id);")
+            for eq, address, incoming_amount, outgoing_amount, balance in self.new_storage_cur:
+                address = self.read_address(address)[0]
+                node = self.ctx.nodes_by_address.get(address)
+                if node is None:
+                    assert False, "Can't find node by address " + address
+                json_node["tl_"+str(eq)+","+node.node_name] = {
+                    "equivalent": eq,
+                    "contractor_id": node.node_name,
+                    "incoming_trust_amount": self.amount_value(incoming_amount),
+                    "outgoing_trust_amount": self.amount_value(outgoing_amount),
+                    "balance": self.amount_value(balance)
+                }
+            trust_lines_count = len(json_node)
+
+            self.new_storage_cur.execute(
+                "SELECT operation_uuid, operation_timestamp, record_type, record_body, equivalent "
+                "FROM history "
+                "WHERE record_type IN (?, ?);",
+                (self.TRUST_LINE_RECORD_TYPE, self.PAYMENT_RECORD_TYPE))
+            for row in self.new_storage_cur:
+                record_body = row[3]
+                # Trust line records keep the contractor id before the address, the addresses count is 1
+                if row[2] == self.TRUST_LINE_RECORD_TYPE:
+                    address, pos = self.read_address(record_body, 1 + 4 + 1)
+                    amounts = record_body[pos:]
+                else:
+                    address, pos = self.read_address(record_body, 1 + 1)
+                    amounts = record_body[pos:len(record_body) - self.PAYMENT_RECORD_SUFFIX_SIZE]
+                node = self.ctx.nodes_by_address.get(address)
+                if node is None:
+                    key, record = self.history_record(row[:4], row[4], address, amounts)
+                    json_ignored_node[key] = record
+                    continue
+                key, record = self.history_record(row[:4], row[4], node.node_name, amounts)
+                json_node[key] = record
+        finally:
+            self.db_disconnect(False)
+        print("\tFound " + str(trust_lines_count) + " trust lines and " +
+              str(len(json_node) - trust_lines_count) + " history records, " +
+              str(len(json_ignored_node)) + " ignored")
+        self.ctx.count_records("compare", "new trust lines", trust_lines_count)
+        self.ctx.count_records("compare", "new history records", len(json_node) - trust_lines_count)
+        self.ctx.count_records("compare", "new ignored history records", len(json_ignored_node))
+        return json_node, json_ignored_node
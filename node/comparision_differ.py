@@ -0,0 +1,52 @@
+import json
+
+
+class ComparisionDiffer:
+    # Walks the old and the new comparision stores node by node and record by record, so only
+    # one node of each side is in memory. Every mismatch is (node, record key, field, old, new).
+    # A record missing on one side has no field and None on that side, a node missing on one
+    # side has no record key either and the records count of the other side.
+    def __init__(self, old_store, new_store, samples_max=10):
+        self.old_store = old_store
+        self.new_store = new_store
+        self.samples_max = samples_max
+        self.samples = []
+        self.mismatches_count = 0
+
+    def mismatches(self):
+        new_node_names = self.new_store.index()
+        for node_name, old_records, _ in self.old_store.iterate():
+            new_node_entry = self.new_store.load_node(node_name)
+            if new_node_entry is None:
+                yield node_name, None, None, len(old_records), None
+                continue
+            yield from self.node_mismatches(node_name, old_records, new_node_entry["records"])
+        old_node_names = self.old_store.index()
+        for node_name in new_node_names:
+            if node_name not in old_node_names:
+                yield node_name, None, None, None, len(self.new_store.load_node(node_name)["records"])
+
+    @staticmethod
+    def node_mismatches(node_name, old_records, new_records):
+        for key in sorted(set(old_records.keys()) | set(new_records.keys())):
+            old_record = old_records.get(key)
+            new_record = new_records.get(key)
+            if old_record is None or new_record is None:
+                yield node_name, key, None, old_record, new_record
+                continue
+            for field in sorted(set(old_record.keys()) | set(new_record.keys())):
+                old_value = old_record.get(field)
+                new_value = new_record.get(field)
+                if old_value != new_value or type(old_value) != type(new_value):
+                    yield node_name, key, field, old_value, new_value
+
+    def write(self, diff_file_path):
+        # Mismatches are written as JSON Lines, the first ones are also kept for the report
+        with open(diff_file_path, 'w') as diff_file_out:
+            for node_name, key, field, old_value, new_value in self.mismatches():
+                mismatch = {"node": node_name, "key": key, "field": field, "old": old_value, "new": new_value}
+                diff_file_out.write(json.dumps(mismatch, ensure_ascii=False) + "\n")
+                self.mismatches_count += 1
+                if len(self.samples) < self.samples_max:
+                    self.samples.append(mismatch)
+        return self.mismatches_count
@@ -0,0 +1,98 @@
+import json
+import os
+
+
+class ComparisionStore:
+    # Append-only JSON Lines file with the comparision results of one side (old or new nodes).
+    # Every compared node is one line, so saving a node costs only that node. A node compared
+    # again is appended anew and its latest line wins. A line torn by a crash is cut off on open.
+    NODE_PREFIX = '{"node": '
+
+    def __init__(self, path):
+        self.path = path
+        self.node_offsets = None
+
+    def open(self):
+        if not os.path.isfile(self.path):
+            return
+        with open(self.path, 'rb') as store_file:
+            valid_size = 0
+            for line in store_file:
+                if not line.endswith(b'\n'):
+                    break
+                valid_size += len(line)
+        if valid_size < os.path.getsize(self.path):
+            with open(self.path, 'r+b') as store_file:
+                store_file.truncate(valid_size)
+
+    def index(self):
+        # Offsets of the latest line of every node, only node names are decoded
+        if self.node_offsets is not None:
+            return self.node_offsets
+        self.node_offsets = dict()
+        if not os.path.isfile(self.path):
+            return self.node_offsets
+        decoder = json.JSONDecoder()
+        with open(self.path, 'rb') as store_file:
+            offset = 0
+            for line in store_file:
+                if line.endswith(b'\n'):
+                    node_name = decoder.raw_decode(line.decode("utf-8"), len(self.NODE_PREFIX))[0]
+                    self.node_offsets[node_name] = offset
+                offset += len(line)
+        return self.node_offsets
+
+    def append_lines(self, lines):
+        with open(self.path, 'ab') as store_file:
+            offset = store_file.tell()
+            for node_name, line in lines:
+                store_file.write(line)
+                if self.node_offsets is not None:
+                    self.node_offsets[node_name] = offset
+                offset += len(line)
+            store_file.flush()
+            os.fsync(store_file.fileno())
+
+    def save_node(self, node_name, records, ignored):
+        # The node name goes first, so that the index can read it without decoding the records
+        line = (self.NODE_PREFIX + json.dumps(node_name) +
+                ', "records": ' + json.dumps(records, sort_keys=True, ensure_ascii=False) +
+                ', "ignored": ' + json.dumps(ignored, sort_keys=True, ensure_ascii=False) + "}\n")
+        self.append_lines([(node_name, line.encode("utf-8"))])
+
+    def read_line(self, store_file, node_name):
+        store_file.seek(self.index()[node_name])
+        return store_file.readline()
+
+    def load_node(self, node_name):
+        if node_name not in self.index():
+            return None
+        with open(self.path, 'rb') as store_file:
+            return json.loads(self.read_line(store_file, node_name))
+
+    def iterate(self):
+        # Yields node name, records and ignored records, one node in memory at a time
+        node_offsets = self.index()
+        if len(node_offsets) == 0:
+            return
+        with open(self.path, 'rb') as store_file:
+            for node_name in node_offsets:
+                node_entry = json.loads(self.read_line(store_file, node_name))
+                yield node_name, node_entry["records"], node_entry["ignored"]
+
+    def nodes_count(self):
+        return len(self.index())
+
+    def merge(self, shard):
+        # Copies the latest line of every node of another store as is, without decoding it
+        shard_offsets = shard.index()
+        if len(shard_offsets) == 0:
+            return
+        self.index()
+        with open(shard.path, 'rb') as shard_file:
+            self.append_lines((node_name, shard.read_line(shard_file, node_name)) for node_name in shard_offsets)
+
+    def remove(self):
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+        self.node_offsets = None
@@ -1,8 +1,11 @@
 import os, sys
+import atexit
+import collections
+import queue
 import subprocess
 import logging
+import logging.handlers
 import tempfile
-import pickle
 import json
 from datetime import datetime
 
@@ -10,6 +13,11 @@ from settings import migration_conf
 
 
 class Context:
+    # Log records of all contexts of a process go through one queue to one listener thread
+    log_queue = None
+    log_listener = None
+    log_pid = None
+
     def __init__(self):
         # For all operations:
         self.verbose = False
@@ -31,17 +39,34 @@ class Context:
         self.address = None
         self.observers = "127.0.0.1:4000,127.0.0.1:4001,127.0.0.1:4002"
         self.in_memory = False
+        self.max_open_nodes = 64
+        self.memory_budget = None
+        self.connection_pool = None
+        self.jobs = None
+        self.history_batch_size = 10000
+        self.stream_history = False
         self.migration_error_json = None
         self.channels = None
+        self.profiler = None
 
         # Comparision operation specific:
-        self.old_comparision_json = {}
-        self.new_comparision_json = {}
-        self.old_ignored_json = {}
-        self.new_ignored_json = {}
+        self.old_comparision_store = None
+        self.new_comparision_store = None
         self.nodes_count_processed = 0
         self.nodes_count_max = sys.maxsize
         self.threads = None
+        self.history_page_size = 10000
+        self.offline = False
+
+        # Node execution specific (comparision, validation):
+        self.node_ready_probe = "fifo"
+        self.node_ready_timeout = 30.0
+        self.node_start_latencies = []
+        self.warm_nodes = 0
+        self.node_supervisor = None
+
+        # Record counters of every phase, logged as one summary line instead of a line per record
+        self.phase_counters = dict()
 
         # Correlation operation specific:
         self.redis = None
@@ -77,6 +102,27 @@ class Context:
                 )
             client_proc.wait()
 
+    def report_node_start_up(self):
+        if len(self.node_start_latencies) == 0:
+            return
+        latencies = sorted(self.node_start_latencies, key=lambda latency: latency[1])
+        average = sum(latency[1] for latency in latencies) / len(latencies)
+        print("Node start-up (" + self.node_ready_probe + "): launches=" + str(len(latencies)) +
+              " avg={:.1f}ms".format(average * 1000) +
+              " max={:.1f}ms".format(latencies[-1][1] * 1000) + " (" + latencies[-1][0] + ")")
+
+    def count_records(self, phase, name, count=1):
+        counters = self.phase_counters.get(phase)
+        if counters is None:
+            counters = self.phase_counters[phase] = collections.Counter()
+        counters[name] += count
+
+    def log_phase_counters(self, phase):
+        counters = self.phase_counters.pop(phase, None)
+        if counters is None:
+            return
+        self.logger.info(phase + ": " + ", ".join(name + "=" + str(counters[name]) for name in sorted(counters)))
+
     def append_migration_error(self, entry):
         if self.migration_error_json is None:
             self.migration_error_json = {}
@@ -94,21 +140,6 @@ class Context:
         with open(filename, 'w') as cpm_file_out:
             json.dump(json_obj, cpm_file_out, sort_keys=True, indent=4, ensure_ascii=False)
 
-    def save(self):
-        pass
-        #binary_file = open('./pickled_migration.bin', mode='wb')
-        #pickle.dump(self, binary_file)
-        #binary_file.close()
-
-    @staticmethod
-    def load():
-        if os.path.isfile('./pickled_migration.bin'):
-            binary_file = open('./pickled_migration.bin', mode='rb')
-            obl = pickle.load(binary_file)
-            binary_file.close()
-            return obl
-        return None
-
     def eq_map(self, eq):
         if self.new_equivalents is not None:
             new_eq = self.new_equivalents.get(eq, None)
@@ -119,58 +150,94 @@ class Context:
 
     @staticmethod
     def terminate():
+        Context.stop_logging()
         with tempfile.TemporaryFile() as client_f:
             subprocess.Popen(['kill', '-9', str(os.getpid())], stdout=client_f, stderr=client_f)
 
     def __init_logging(self) -> None:
-        self.file_handler = None
-        self.errors_handler = None
-        self.logger = None
-
         self.logger = logging.getLogger()
-        stream_handler = logging.StreamHandler()
-
-        formatter = logging.Formatter('%(asctime)s: %(message)s')
-        stream_handler.setFormatter(formatter)
-
-        self.logger.addHandler(stream_handler)
-
-        self.reinit_logging()
+        # A forked worker does not have the listener thread of its parent, so it starts its own
+        if Context.log_pid != os.getpid():
+            for handler in list(self.logger.handlers):
+                if isinstance(handler, logging.handlers.QueueHandler):
+                    self.logger.removeHandler(handler)
+            Context.log_queue = queue.SimpleQueue()
+            Context.log_listener = None
+            Context.log_pid = os.getpid()
+            self.logger.addHandler(logging.handlers.QueueHandler(Context.log_queue))
+            self.reinit_logging()
+            atexit.register(Context.stop_logging)
+        self.set_logging_level()
 
     def reinit_logging(self):
-        if self.file_handler is not None:
-            self.logger.removeHandler(self.file_handler)
-            self.logger.removeHandler(self.errors_handler)
-            self.file_handler.close()
-            self.errors_handler.close()
+        # The terminal and the log files are written by the listener thread only, so a hot loop
+        # logging records never waits on them
+        if Context.log_listener is not None:
+            Context.log_listener.stop()
+            for handler in Context.log_listener.handlers:
+                handler.close()
             postfix = "_" + str(datetime.now())
         else:
             postfix = ""
 
-        self.file_handler = logging.FileHandler('operations'+postfix+'.log')
-        self.errors_handler = logging.FileHandler('errors'+postfix+'.log')
-        self.errors_handler.setLevel(logging.ERROR)
+        stream_handler = logging.StreamHandler()
+        file_handler = logging.FileHandler('operations'+postfix+'.log')
+        errors_handler = logging.FileHandler('errors'+postfix+'.log')
+        errors_handler.setLevel(logging.ERROR)
 
         formatter = logging.Formatter('%(asctime)s: %(message)s')
-        self.file_handler.setFormatter(formatter)
-        self.errors_handler.setFormatter(formatter)
+        stream_handler.setFormatter(formatter)
+        file_handler.setFormatter(formatter)
+        errors_handler.setFormatter(formatter)
 
-        self.logger.addHandler(self.file_handler)
-        self.logger.addHandler(self.errors_handler)
+        Context.log_listener = logging.handlers.QueueListener(
+            Context.log_queue, stream_handler, file_handler, errors_handler, respect_handler_level=True)
+        Context.log_listener.start()
+        self.set_logging_level()
 
-        if self.debug:
+    def set_logging_level(self):
+        # Lines per record are logged at DEBUG level, they are shown in debug or verbose mode only
+        if self.debug or self.verbose:
             self.logger.setLevel(logging.DEBUG)
         else:
             self.logger.setLevel(logging.INFO)
 
+    @staticmethod
+    def stop_logging():
+        # Flushes the queued records, a process has to do it before it exits
+        if Context.log_listener is not None and Context.log_pid == os.getpid():
+            Context.log_listener.stop()
+            Context.log_listener = None
+
 
 class Channel:
+    __slots__ = (
+        'id',
+        'id_on_contractor_side',
+    )
+
     def __init__(self):
         self.id = None
         self.id_on_contractor_side = None
 
 
 class TrustLine:
+    __slots__ = (
+        'id',
+        'contractor_id',
+        'contractor',
+        'incoming_amount',
+        'outgoing_amount',
+        'balance',
+        'is_contractor_gateway',
+        'equivalent',
+        'number',
+        'our_key_hash',
+        'our_signature',
+        'own_keys_set_hash',
+        'contractor_keys_set_hash',
+    )
+
     def __init__(self):
         self.id = None
         self.contractor_id = None
@@ -189,6 +256,13 @@ class TrustLine:
 
 
 class TrustLineStat:
+    __slots__ = (
+        'eq',
+        'count_all',
+        'count_0_bal',
+        'count_non_0_bal',
+    )
+
     def __init__(self):
         self.eq = 0
         self.count_all = 0
@@ -197,6 +271,16 @@ class TrustLineStat:
 
 
 class OwnKey:
+    __slots__ = (
+        'hash',
+        'trust_line_id',
+        'keys_set_sequence_number',
+        'public_key',
+        'private_key',
+        'number',
+        'is_valid',
+    )
+
     def __init__(self):
         self.hash = None
         self.trust_line_id = None
@@ -208,6 +292,16 @@ class OwnKey:
 
 
 class History:
+    __slots__ = (
+        'operation_uuid',
+        'operation_timestamp',
+        'record_type',
+        'record_body',
+        'record_body_bytes_count',
+        'equivalent',
+        'command_uuid',
+    )
+
     def __init__(self):
         self.operation_uuid = None
         self.operation_timestamp = None
@@ -219,6 +313,14 @@ class History:
 
 
 class CommunicatorMessage:
+    __slots__ = (
+        'contractor_uuid',
+        'transaction_uuid',
+        'message_type',
+        'recording_time',
+        'equivalent',
+    )
+
     def __init__(self):
         self.contractor_uuid = None
         self.transaction_uuid = None
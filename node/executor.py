@@ -1,9 +1,16 @@
+import errno
+import fcntl
 import json
 import os
+import selectors
+import struct
 import subprocess
+import termios
 import tempfile
+import threading
 import time
 from random import randint
+from uuid import uuid4
 
 from node.generator import NodeGenerator
 
@@ -27,10 +34,13 @@ class NodeExecutor(NodeGenerator):
         if os.path.exists(self.new_commands_fifo_path):
             os.remove(self.new_commands_fifo_path)
 
-        self.result_fifo_handler = None
-        self.command_result = None
+        self.result_fifo_wakeups = dict()
+        self.node_handles = dict()
+        self.command_results = {}
+        # UUIDs the running sessions wait for, responses to any other command are dropped
+        self.expected_commands = set()
+        self.command_results_ready = threading.Condition()
 
-        self.node_idx = len(self.ctx.nodes)
         self.update_conf_json()
         self.read_new_conf_json()
 
@@ -73,25 +83,56 @@ class NodeExecutor(NodeGenerator):
             with open(os.path.join(self.old_node_path, "conf.json"), 'w') as conf_file_out:
                 json.dump(data, conf_file_out, sort_keys=True, indent=4, ensure_ascii=False)
 
-    def open_node_result_fifo(self, result_fifo_path, verbose=True):
+    def open_node_result_fifo(self, result_fifo_path, wakeup_read, verbose=True):
+        # clean() writes into the wakeup pipe to stop the reader
         if verbose:
             print("Opening result FIFO for node " + self.node_name)
-        while True:
-            try:
-                #self.result_fifo_handler = os.fdopen(os.open(result_fifo_path, os.O_RDONLY | os.O_NONBLOCK), 'rb')
-                self.result_fifo_handler = os.fdopen(os.open(result_fifo_path, os.O_NONBLOCK), 'rb')
-                break
-            except:
-                continue
-        while self.result_fifo_handler is not None:
-            data = None
-            try:
-                data = self.result_fifo_handler.read()
-            except:
-                None
-            if data is None or len(data) == 0:
-                continue
-            self.command_result = data
+        selector = selectors.DefaultSelector()
+        selector.register(wakeup_read, selectors.EVENT_READ)
+        fifo_fds = []
+        try:
+            # The node creates its result FIFO on start-up
+            while not os.path.exists(result_fifo_path):
+                if selector.select(0.01):
+                    return
+            fifo_read = os.open(result_fifo_path, os.O_RDONLY | os.O_NONBLOCK)
+            fifo_fds.append(fifo_read)
+            # Holding a write end of our own keeps the FIFO from signalling hang-up every time
+            # the node closes its end, so select() only returns when there is data to read
+            fifo_fds.append(os.open(result_fifo_path, os.O_WRONLY | os.O_NONBLOCK))
+            selector.register(fifo_read, selectors.EVENT_READ)
+
+            # Responses are newline terminated, a large one may arrive in several chunks
+            data = b''
+            while True:
+                for key, events in selector.select():
+                    if key.fd == wakeup_read:
+                        return
+                    while True:
+                        try:
+                            chunk = os.read(fifo_read, 65536)
+                        except BlockingIOError:
+                            break
+                        if not chunk:
+                            break
+                        data += chunk
+                    while True:
+                        line_end = data.find(b'\n')
+                        if line_end < 0:
+                            break
+                        result = data[:line_end + 1]
+                        data = data[line_end + 1:]
+                        # Every response starts with the UUID of the command it answers
+                        command_uuid = result[:result.find(b'\t')].decode()
+                        with self.command_results_ready:
+                            if command_uuid in self.expected_commands:
+                                self.command_results[command_uuid] = result
+                                self.command_results_ready.notify_all()
+        finally:
+            selector.close()
+            for fd in fifo_fds:
+                os.close(fd)
+            os.close(wakeup_read)
 
     @staticmethod
     def wait(proc):
@@ -105,21 +146,16 @@ class NodeExecutor(NodeGenerator):
         if verbose:
             print("Starting node: " + self.node_name)
         if un_buf:
+            # Unbuffered output lets the readiness probe see the start-up marker right away
             client_proc = subprocess.Popen(
                 ['stdbuf', '-o0', client_path],
                 #client_path,
                 cwd=node_path,
                 bufsize=0,
-                universal_newlines=True,
                 stdout=subprocess.PIPE,
                 stderr=subprocess.STDOUT
             )
-            for line in iter(client_proc.stdout.readline, b''):
-                line = str(line.rstrip())
-                if self.ctx.verbose:
-                    print(line)
-                if line.find("INFO\t[CORE]\tProcessing started.") > -1:
-                    break
+            return client_proc
         else:
             with tempfile.TemporaryFile() as client_f:
                 client_proc = None
@@ -137,37 +173,206 @@ class NodeExecutor(NodeGenerator):
                     )
             return client_proc
 
+    def start_node(self, node_path, client_path, commands_fifo_path, result_fifo_path, verbose=True):
+        wakeup_read, self.result_fifo_wakeups[result_fifo_path] = os.pipe()
+        threading.Thread(target=self.open_node_result_fifo, args=(result_fifo_path, wakeup_read, verbose)).start()
+
+        # A commands FIFO left by the previous run would pass the probe before the node is up
+        if os.path.exists(commands_fifo_path):
+            os.remove(commands_fifo_path)
+        start_time = time.time()
+        node_handle = self.run_node(node_path, client_path, verbose, self.ctx.node_ready_probe == "marker")
+        self.node_handles[commands_fifo_path] = node_handle
+        try:
+            self.wait_node_ready(node_handle, commands_fifo_path, start_time + self.ctx.node_ready_timeout)
+        except:
+            self.stop_node(node_handle, result_fifo_path)
+            raise
+        latency = time.time() - start_time
+        self.ctx.node_start_latencies.append((self.node_name, latency))
+        if verbose:
+            print("Node " + self.node_name + " is ready in {:.1f}ms".format(latency * 1000))
+        return node_handle
+
+    def stop_node(self, node_handle, result_fifo_path):
+        node_handle.terminate()
+        for commands_fifo_path, running_node_handle in list(self.node_handles.items()):
+            if running_node_handle is node_handle:
+                del self.node_handles[commands_fifo_path]
+        self.clean(result_fifo_path=result_fifo_path)
+
+    def acquire_node(self, node_path, client_path, commands_fifo_path, result_fifo_path, verbose=True):
+        # Nodes are kept running by the supervisor when there is one, and started per call otherwise
+        if self.ctx.node_supervisor is not None:
+            return self.ctx.node_supervisor.acquire(
+                self, node_path, client_path, commands_fifo_path, result_fifo_path, verbose)
+        return self.start_node(node_path, client_path, commands_fifo_path, result_fifo_path, verbose)
+
+    def release_node(self, node_handle, node_path, result_fifo_path, keep=True):
+        # keep=False tells the supervisor that the node is not going to be asked for again
+        if self.ctx.node_supervisor is not None:
+            self.ctx.node_supervisor.release(node_path, keep)
+            return
+        self.stop_node(node_handle, result_fifo_path)
+
+    def wait_node_ready(self, node_handle, commands_fifo_path, deadline):
+        # Probes: 'marker' waits for the start-up line on stdout, 'fifo' for the commands FIFO
+        # and 'ping' additionally for an answer to a request sent through it
+        if self.ctx.node_ready_probe == "marker":
+            self.wait_node_marker(node_handle, deadline)
+            return
+        while not os.path.exists(commands_fifo_path):
+            if node_handle.poll() is not None:
+                assert False, "Node " + self.node_name + " exited during start-up"
+            if time.time() > deadline:
+                assert False, "Node " + self.node_name + " is not ready in " + str(self.ctx.node_ready_timeout) + " sec"
+            time.sleep(0.005)
+        if self.ctx.node_ready_probe == "ping":
+            command_uuid = str(uuid4())
+            self.run_session(
+                commands_fifo_path, [(command_uuid, command_uuid + '\tGET:equivalents\n')],
+                max(deadline - time.time(), 0), 0)
+
+    def wait_node_marker(self, node_handle, deadline):
+        output_fd = node_handle.stdout.fileno()
+        selector = selectors.DefaultSelector()
+        selector.register(output_fd, selectors.EVENT_READ)
+        output = b''
+        try:
+            while output.find(b"INFO\t[CORE]\tProcessing started.") < 0:
+                if not selector.select(max(deadline - time.time(), 0)):
+                    assert False, "Node " + self.node_name + " is not ready in " + str(self.ctx.node_ready_timeout) + " sec"
+                chunk = os.read(output_fd, 65536)
+                if not chunk:
+                    assert False, "Node " + self.node_name + " exited during start-up"
+                if self.ctx.verbose:
+                    print(chunk.decode(errors="replace"), end="")
+                output = output[-64:] + chunk
+        finally:
+            selector.close()
+        # The node must never block on a full output pipe
+        threading.Thread(target=self.drain_node_output, args=(output_fd,), daemon=True).start()
+
+    def drain_node_output(self, output_fd):
+        try:
+            while True:
+                chunk = os.read(output_fd, 65536)
+                if not chunk:
+                    break
+                if self.ctx.verbose:
+                    print(chunk.decode(errors="replace"), end="")
+        except OSError:
+            pass
+
     def run_command(self, fifo, line):
-        send_count = 0
-        max_sent = 5
+        # The UUID the line starts with is replaced by a fresh one, so a late response
+        # to an earlier call can't be taken for the response to this one
         line = line.replace("\\t", '\t').replace("\\n", "\n")
-        line = line.encode()
-        while True:
-            if os.path.exists(fifo):
-                fifo_write = open(fifo, 'wb')
-                fifo_write.write(line)
-                fifo_write.flush()
-                fifo_write.close()
-
-            try_count = 0
-            max_tries = 10 * 60
-            while self.command_result is None and try_count <= max_tries:
-                time.sleep(0.1)
-                try_count += 1
-            if try_count > max_tries:
+        command_uuid = str(uuid4())
+        return self.run_session(fifo, [(command_uuid, command_uuid + line[line.find('\t'):])])[0]
+
+    def run_commands(self, fifo, commands):
+        # Sends all commands at once, each under its own UUID, and returns the responses in the same order
+        session = []
+        for command in commands:
+            command_uuid = str(uuid4())
+            session.append((command_uuid, command_uuid + '\t' + command))
+        return self.run_session(fifo, session)
+
+    def run_session(self, fifo, commands, max_wait=60, max_sent=5):
+        send_count = 0
+        results = {}
+        pending = dict(commands)
+        # A node that died is reported at once instead of after all the resends
+        node_handle = self.node_handles.get(fifo)
+        with self.command_results_ready:
+            self.expected_commands.update(pending)
+        try:
+            while True:
+                deadline = time.time() + max_wait
+                self.write_commands(fifo, ''.join(pending.values()).encode(), node_handle, deadline)
+                self.wait_results(pending, results, node_handle, deadline)
+                if len(pending) == 0:
+                    return [results[command_uuid] for command_uuid, line in commands]
                 send_count += 1
                 if send_count > max_sent:
                     assert False, "No response from node " + self.node_name
                 print("Retrying command sending...")
-                continue
-            result = self.command_result
-            self.command_result = None
-            return result
+        finally:
+            # Responses that come after the session, e.g. to a command sent twice, are not kept
+            with self.command_results_ready:
+                for command_uuid, line in commands:
+                    self.expected_commands.discard(command_uuid)
+                    self.command_results.pop(command_uuid, None)
+
+    def wait_results(self, pending, results, node_handle, deadline):
+        # The FIFO reader hands the responses over as soon as they are complete. A node that is
+        # busy with a large page or a SET is waited for, commands are only sent again after
+        # max_wait, since a SET sent twice would be applied twice
+        with self.command_results_ready:
+            while True:
+                for command_uuid in list(pending):
+                    if command_uuid in self.command_results:
+                        results[command_uuid] = self.command_results.pop(command_uuid)
+                        del pending[command_uuid]
+                if len(pending) == 0 or time.time() >= deadline:
+                    return
+                if node_handle is not None and node_handle.poll() is not None:
+                    assert False, "Node " + self.node_name + " exited with code " + str(node_handle.returncode)
+                self.command_results_ready.wait(min(1.0, max(deadline - time.time(), 0)))
+
+    def write_commands(self, fifo, data, node_handle, deadline):
+        # Until the node has its commands FIFO open for reading there is nobody to take the commands
+        while True:
+            try:
+                fifo_fd = os.open(fifo, os.O_WRONLY | os.O_NONBLOCK)
+                break
+            except OSError as e:
+                if e.errno not in (errno.ENOENT, errno.ENXIO):
+                    raise
+            if node_handle is not None and node_handle.poll() is not None:
+                assert False, "Node " + self.node_name + " exited with code " + str(node_handle.returncode)
+            if time.time() > deadline:
+                return
+            time.sleep(0.01)
+        os.set_blocking(fifo_fd, True)
+        with os.fdopen(fifo_fd, 'wb') as fifo_write:
+            fifo_write.write(data)
+            fifo_write.flush()
+            # Unread commands are dropped when the node closes its end while nobody else has the FIFO
+            # open, as it does to reopen it. Holding the write end until the node has read them all
+            # keeps them in the FIFO for the reopened end, so they never have to be sent again.
+            self.wait_fifo_read(fifo_write.fileno(), node_handle, deadline)
+
+    def wait_fifo_read(self, fifo_fd, node_handle, deadline):
+        # A node reading its commands takes them within a few milliseconds, so this usually returns at
+        # once or after a sleep or two. Only a node that stopped reading keeps it waiting, up to the
+        # session deadline, so the sleep doubles from 1ms to 50ms to poll such a node rarely.
+        unread = struct.pack("i", 0)
+        sleep_time = 0.001
+        while struct.unpack("i", fcntl.ioctl(fifo_fd, termios.FIONREAD, unread))[0] > 0:
+            if node_handle is not None and node_handle.poll() is not None:
+                assert False, "Node " + self.node_name + " exited with code " + str(node_handle.returncode)
+            if time.time() > deadline:
+                return
+            time.sleep(sleep_time)
+            sleep_time = min(sleep_time * 2, 0.05)
 
-    def clean(self, also_clients=True):
+    def clean(self, also_clients=True, result_fifo_path=None):
         #if also_clients:
         #    with tempfile.TemporaryFile() as client_f:
         #        client_proc = subprocess.Popen(['killall', '-q', self.new_client_path], stdout=client_f, stderr=client_f)
         #        client_proc = subprocess.Popen(['killall', '-q', self.old_client_path], stdout=client_f, stderr=client_f)
-        self.result_fifo_handler.close()
-        self.result_fifo_handler = None
+        # Stops the reader of the given result FIFO, or all of them
+        for fifo_path in list(self.result_fifo_wakeups.keys()):
+            if result_fifo_path is not None and fifo_path != result_fifo_path:
+                continue
+            result_fifo_wakeup = self.result_fifo_wakeups.pop(fifo_path)
+            try:
+                os.write(result_fifo_wakeup, b'\0')
+            except OSError:
+                pass
+            os.close(result_fifo_wakeup)
+        if len(self.result_fifo_wakeups) == 0:
+            with self.command_results_ready:
+                self.command_results.clear()
@@ -19,8 +19,15 @@ class NodeGenerator:
         self.old_trust_lines = []
         self.old_history = []
         self.no_gns_address = False
+        # Storage rows read and rows written by closed connections, node steps of the profiler
+        # and the largest RSS high-water mark of the node clients run in the current step
+        self.rows_read = 0
+        self.rows_written = 0
+        self.phase_stats = dict()
+        self.client_rss_high_water_kb = 0
 
         self.node_name = node_name
+        self.node_idx = len(self.ctx.nodes)
         self.read_conf_json()
 
         if assertions and self.new_node_address is None:
@@ -34,8 +41,18 @@ class NodeGenerator:
         if self.ctx.in_memory:
             self.db_connect(False)
 
+    def __getstate__(self):
+        # Context and live SQLite handles can't cross process boundaries,
+        # they are re-attached by the receiving side
+        state = self.__dict__.copy()
+        state['ctx'] = None
+        for key, value in state.items():
+            if isinstance(value, (sqlite3.Connection, sqlite3.Cursor)):
+                state[key] = None
+        return state
+
     def generate(self):
-        print("Generating node #"+str(len(self.ctx.nodes)+1)+": " + self.node_name)
+        print("Generating node #"+str(self.node_idx+1)+": " + self.node_name)
         self.generate_conf_json()
         self.generate_tables()
 
@@ -64,7 +81,7 @@ class NodeGenerator:
                             #    os.path.join(self.new_node_path, "..", self.new_node_address))
                         else:
                             self.no_gns_address = True
-                            print("Error: Node #" + str(len(self.ctx.nodes) + 1) + ": " + self.node_name +
+                            print("Error: Node #" + str(self.node_idx + 1) + ": " + self.node_name +
                                   " has no gns address")
         except:
             self.ctx.append_migration_error({
@@ -114,7 +131,8 @@ class NodeGenerator:
 
     def retrieve_old_data(self):
         self.retrieve_old_trust_lines()
-        self.retrieve_old_history()
+        if not self.ctx.stream_history:
+            self.retrieve_old_history()
 
     @staticmethod
     def read_amount(blob):
@@ -140,6 +158,7 @@ class NodeGenerator:
             "SELECT contractor, incoming_amount, outgoing_amount, balance, is_contractor_gateway, equivalent "
             "FROM trust_lines;")
         rows = self.old_storage_cur.fetchall()
+        self.rows_read += len(rows)
         for row in rows:
             trust_line = context.TrustLine()
             self.old_trust_lines.append(trust_line)
@@ -152,14 +171,18 @@ class NodeGenerator:
             trust_line.equivalent = self.ctx.eq_map(row[5])
 
     def retrieve_old_history(self):
+        self.old_history = list(self.iterate_old_history())
+
+    def iterate_old_history(self):
+        # Rows are converted as the cursor advances, so a consumer that writes them out
+        # as it goes never holds more than its own batch in memory
         self.old_storage_cur.execute(
             "SELECT operation_uuid, operation_timestamp, record_type, record_body, "
                 "record_body_bytes_count, equivalent, command_uuid "
             "FROM history;")
-        rows = self.old_storage_cur.fetchall()
-        for row in rows:
+        for row in self.old_storage_cur:
+            self.rows_read += 1
             history = context.History()
-            self.old_history.append(history)
             history.operation_uuid = row[0]
             history.operation_timestamp = row[1]
             history.record_type = row[2]
@@ -167,6 +190,7 @@ class NodeGenerator:
             history.record_body_bytes_count = row[4]
             history.equivalent = self.ctx.eq_map(row[5])
             history.command_uuid = row[6]
+            yield history
 
     def generate_tables(self):
         self.new_storage_cur.execute(
@@ -318,6 +342,26 @@ class NodeGenerator:
             ")"
         )
 
+    def db_acquire(self, connect=True):
+        # Storages stay open for the whole run in 'in_memory' mode, are kept in the pool
+        # of recently used nodes when there is one, and are opened per call otherwise.
+        # With connect=False only the node's cached data is made resident in the pool.
+        if self.ctx.in_memory:
+            return
+        if self.ctx.connection_pool is not None:
+            self.ctx.connection_pool.acquire(self, connect)
+        elif connect:
+            self.db_connect(False)
+
+    def db_release(self, close=False):
+        if self.ctx.connection_pool is not None:
+            if close:
+                self.ctx.connection_pool.release(self)
+            return
+        if self.ctx.in_memory and not close:
+            return
+        self.db_disconnect(False)
+
     def db_connect(self, verbose=True):
         if verbose:
             print("Connecting to db of node: " + self.node_name)
@@ -334,9 +378,16 @@ class NodeGenerator:
         if self.new_node_path is not None:
             self.new_storage_con.commit()
             self.new_storage_cur.close()
+            self.rows_written += self.new_storage_con.total_changes
         self.old_storage_con = self.old_storage_cur = None
         self.new_storage_con = self.new_storage_cur = None
 
+    def storage_rows(self):
+        rows_written = self.rows_written
+        if self.new_storage_con is not None:
+            rows_written += self.new_storage_con.total_changes
+        return self.rows_read, rows_written
+
     @staticmethod
     def read_uuid(blob):
         uuid = str(binascii.hexlify(blob))
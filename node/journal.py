@@ -0,0 +1,90 @@
+import os
+import pickle
+
+
+class MigrationJournal:
+    # Append-only log of completed migration phases, kept next to the migrated infrastructure.
+    # Every record is a separate pickle, so a record torn by a crash is cut off on load
+    # and the migration resumes from the last record that was fully written.
+    def __init__(self, path):
+        self.path = path
+        self.context_state = None
+        self.node_states = dict()
+        self.channels = []
+        self.phases = set()
+        self.node_phases = dict()
+
+    def load(self):
+        if not os.path.isfile(self.path):
+            return False
+        with open(self.path, 'rb') as journal_file:
+            valid_size = 0
+            while True:
+                try:
+                    record = pickle.load(journal_file)
+                except Exception:
+                    break
+                valid_size = journal_file.tell()
+                self.apply(record)
+        if valid_size < os.path.getsize(self.path):
+            with open(self.path, 'r+b') as journal_file:
+                journal_file.truncate(valid_size)
+        # Node states and channels are only usable once the whole snapshot was written
+        return "channels" in self.phases
+
+    def apply(self, record):
+        kind = record[0]
+        if kind == "context":
+            self.context_state = record[1]
+        elif kind == "node_state":
+            self.node_states[record[1]] = record[2]
+        elif kind == "channels":
+            self.channels = record[1]
+        elif kind == "phase":
+            self.phases.add(record[1])
+        elif kind == "node":
+            self.node_phases.setdefault(record[1], dict())[record[2]] = record[3]
+
+    def append(self, records):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, 'ab') as journal_file:
+            for record in records:
+                pickle.dump(record, journal_file, pickle.HIGHEST_PROTOCOL)
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+
+    def save_snapshot(self, context_state, nodes, channels):
+        self.append(self.snapshot_records(context_state, nodes, channels))
+        self.mark_phase("channels")
+
+    @staticmethod
+    def snapshot_records(context_state, nodes, channels):
+        yield "context", context_state
+        for node in nodes:
+            yield "node_state", node.node_name, node.checkpoint_state()
+        yield "channels", [
+            (channel.node1.node_name, channel.node2.node_name,
+             channel.id_on_contractor_side1, channel.id_on_contractor_side2)
+            for channel in channels
+        ]
+
+    def mark_phase(self, phase):
+        self.append([("phase", phase)])
+        self.phases.add(phase)
+
+    def mark_node(self, phase, node_name, payload=None):
+        self.append([("node", phase, node_name, payload)])
+        self.node_phases.setdefault(phase, dict())[node_name] = payload
+
+    def is_phase_done(self, phase):
+        return phase in self.phases
+
+    def is_node_done(self, phase, node_name):
+        return node_name in self.node_phases.get(phase, {})
+
+    def node_payload(self, phase, node_name):
+        return self.node_phases.get(phase, {}).get(node_name)
+
+    def remove(self):
+        if os.path.isfile(self.path):
+            os.remove(self.path)
@@ -1,7 +1,12 @@
+import itertools
+import os
+import pickle
 import sqlite3
 import subprocess
 import tempfile
+import time
 import struct
+import sys
 
 from node.generator import NodeGenerator
 
@@ -9,6 +14,19 @@ from node import context
 
 
 class NodeMigrator(NodeGenerator):
+    worker_ctx = None
+
+    # Per-node data that is written to disk when the node is evicted under a memory budget
+    spilled_attributes = (
+        'old_trust_lines',
+        'old_history',
+        'channels',
+        'trust_lines',
+        'trust_lines_by_contractor',
+        'trust_lines_by_equivalent',
+        'own_keys',
+    )
+
     def __init__(self, ctx, node_name, old_node_path, new_node_path, new_node_address, client_path):
         super().__init__(ctx, node_name, old_node_path, new_node_path, new_node_address)
         self.client_path = client_path
@@ -16,11 +34,29 @@ class NodeMigrator(NodeGenerator):
 
         self.channels = dict()
         self.trust_lines = dict()
+        self.trust_lines_by_contractor = dict()
+        self.trust_lines_by_equivalent = dict()
         self.own_keys = None
+        self.own_keys_count = 0
+        self.spill_path = None
+
+    @staticmethod
+    def init_worker(ctx):
+        NodeMigrator.worker_ctx = ctx
+
+    @staticmethod
+    def generate_worker(node_migrator):
+        node_migrator.ctx = NodeMigrator.worker_ctx
+        node_migrator.db_connect(False)
+        with node_migrator.ctx.profiler.node_phase("generate", node_migrator):
+            node_migrator.generate()
+        with node_migrator.ctx.profiler.node_phase("retrieve", node_migrator):
+            node_migrator.retrieve_old_data()
+        node_migrator.db_disconnect(False)
+        return node_migrator
 
     def add_channel(self, pk, sk, ok, id_on_contractor_side, contractor_address):
-        if not self.ctx.in_memory:
-            self.db_connect(False)
+        self.db_acquire()
         self.new_storage_cur.execute(
             "insert into contractors ('id', 'id_on_contractor_side', 'crypto_key', 'is_confirmed') "
             "values (?, ?, "
@@ -50,21 +86,17 @@ class NodeMigrator(NodeGenerator):
             )
 
         self.channel_idx += 1
-        if not self.ctx.in_memory:
-            self.db_disconnect(False)
+        self.db_release()
 
     def add_trust_lines(self, local_id, contractor_id):
-        if not self.ctx.in_memory:
-            self.db_connect(False)
+        self.db_acquire()
         for old_trust_line in self.old_trust_lines:
             if old_trust_line.contractor_id != contractor_id:
                 continue
-            print(
-                "\tGenerating trust line for node: " + self.node_name +
-                " id: " + str(local_id) +
-                " eq: " + str(old_trust_line.equivalent) +
-                " gw: " + str(old_trust_line.is_contractor_gateway)
-            )
+            self.ctx.logger.debug(
+                "\tGenerating trust line for node: %s id: %s eq: %s gw: %s",
+                self.node_name, local_id, old_trust_line.equivalent, old_trust_line.is_contractor_gateway)
+            self.ctx.count_records("trust lines", "trust lines")
             self.new_storage_cur.execute(
                 "insert into trust_lines ('state', 'contractor_id', 'equivalent', 'is_contractor_gateway') "
                 "values ('2', ?, ?, ?);",
@@ -73,10 +105,10 @@ class NodeMigrator(NodeGenerator):
             old_trust_line.id = self.new_storage_cur.lastrowid
 
             trust_line = context.TrustLine()
-            self.trust_lines[old_trust_line.id] = trust_line
             trust_line.id = old_trust_line.id
             trust_line.contractor_id = local_id
             trust_line.equivalent = old_trust_line.equivalent
+            self.index_trust_line(trust_line)
 
             self.new_storage_cur.execute(
                 "insert into audit ("
@@ -98,8 +130,13 @@ class NodeMigrator(NodeGenerator):
                     sqlite3.Binary(old_trust_line.incoming_amount)
                 )
             )
-        if not self.ctx.in_memory:
-            self.db_disconnect(False)
+        self.db_release()
+
+    def index_trust_line(self, trust_line):
+        self.trust_lines[trust_line.id] = trust_line
+        self.trust_lines_by_contractor.setdefault(trust_line.contractor_id, []).append(trust_line)
+        self.trust_lines_by_equivalent.setdefault(
+            (trust_line.contractor_id, trust_line.equivalent), []).append(trust_line)
 
     def add_contractor_key(self, own_key1, own_key2):
         self.new_storage_cur.execute(
@@ -119,8 +156,7 @@ class NodeMigrator(NodeGenerator):
         )
 
     def update_audit_crypto(self, trust_line_id, contractor_key_hash, contractor_signature):
-        if not self.ctx.in_memory:
-            self.db_connect(False)
+        self.db_acquire()
         self.new_storage_cur.execute(
             "update audit set "
                 "contractor_key_hash = ?, "
@@ -132,23 +168,39 @@ class NodeMigrator(NodeGenerator):
                 trust_line_id
             )
         )
-        if not self.ctx.in_memory:
-            self.db_disconnect(False)
+        self.db_release()
 
     def retrieve_own_keys(self):
         print("Starting node [own_keys]: " + self.node_name)
         self.run_and_wait()
+        self.drop_own_keys()
+
+    def drop_own_keys(self):
+        # A spilled node is restored first, so that its spilled own keys can't come back later,
+        # and the smaller estimate is accounted by the memory budget at once
+        self.db_acquire(False)
+        self.own_keys = None
+        self.own_keys_count = 0
+        if self.ctx.connection_pool is not None and self.ctx.connection_pool.memory_budget is not None:
+            self.ctx.connection_pool.update_bytes(self)
 
     def load_own_keys(self, trust_line_id):
+        if self.own_keys is None:
+            self.load_all_own_keys()
+        return self.own_keys.get(trust_line_id, [])
+
+    def load_all_own_keys(self):
+        # Reads the whole own_keys table at once, grouped by trust line,
+        # so every channel of the node is served without further queries
         self.new_storage_cur.execute(
             "SELECT hash, trust_line_id, keys_set_sequence_number, public_key, private_key, number, is_valid "
-            "FROM own_keys WHERE trust_line_id=?;",
-            (trust_line_id,))
-        rows = self.new_storage_cur.fetchall()
-        own_keys = []
-        for row in rows:
+            "FROM own_keys;")
+        self.own_keys = dict()
+        self.own_keys_count = 0
+        for row in self.new_storage_cur:
+            self.own_keys_count += 1
             own_key = context.OwnKey()
-            own_keys.append(own_key)
+            self.own_keys.setdefault(row[1], []).append(own_key)
             own_key.hash = row[0]
             own_key.trust_line_id = row[1]
             own_key.keys_set_sequence_number = row[2]
@@ -156,17 +208,21 @@ class NodeMigrator(NodeGenerator):
             own_key.private_key = row[4]
             own_key.number = row[5]
             own_key.is_valid = row[6]
-        return own_keys
+        self.rows_read += self.own_keys_count
 
     def hash_audits(self):
         print("Starting node [audit]: " + self.node_name)
+        self.drop_own_keys()
         self.run_and_wait()
-        if not self.ctx.in_memory:
-            self.db_connect(False)
+        self.load_audits()
+
+    def load_audits(self):
+        self.db_acquire()
         self.new_storage_cur.execute(
             "SELECT number, trust_line_id, our_key_hash, our_signature, own_keys_set_hash, contractor_keys_set_hash "
             "FROM audit;")
         rows = self.new_storage_cur.fetchall()
+        self.rows_read += len(rows)
         for row in rows:
             trust_line = self.trust_lines.get(row[1], None)
             if trust_line is None:
@@ -176,10 +232,43 @@ class NodeMigrator(NodeGenerator):
             trust_line.our_signature = row[3]
             trust_line.own_keys_set_hash = row[4]
             trust_line.contractor_keys_set_hash = row[5]
-        if not self.ctx.in_memory:
-            self.db_disconnect(False)
+        self.db_release()
 
     def migrate_history(self):
+        self.history_records_added = 0
+        self.history_records_skipped = 0
+        self.history_contractors = dict()
+
+        start_time = time.time()
+        if self.ctx.stream_history or self.old_history is None:
+            rows = self.rewrite_history(self.iterate_old_history())
+        else:
+            rows = self.rewrite_history(self.old_history)
+        rows_count = 0
+        while True:
+            batch = list(itertools.islice(rows, self.ctx.history_batch_size))
+            if len(batch) == 0:
+                break
+            self.new_storage_cur.executemany(
+                "insert into history ("
+                "'operation_uuid', 'operation_timestamp', 'record_type', 'record_body', "
+                "'record_body_bytes_count', 'equivalent', 'command_uuid'"
+                ") "
+                "values (?, ?, ?, ?, ?, ?, ?);",
+                batch
+            )
+            rows_count += len(batch)
+        self.new_storage_con.commit()
+        elapsed_time = time.time() - start_time
+
+        print(
+            "Generating history for node: " + self.node_name +
+            " added: " + str(self.history_records_added) +
+            " unknowned: " + str(self.history_records_skipped) +
+            " rows/sec: " + str(int(rows_count / elapsed_time) if elapsed_time > 0 else rows_count)
+        )
+
+    def rewrite_history(self, histories):
         trust_line_record_type = 1
         payment_record_type = 2
         payment_additional_record_type = 3
@@ -187,97 +276,156 @@ class NodeMigrator(NodeGenerator):
         operation_type_size = 1
         node_uuid_size = 16
 
-        records_added = 0
-        records_skipped = 0
+        address_pos_begin = operation_type_size
+        address_pos_end = (address_pos_begin + node_uuid_size)
 
-        for history in self.old_history:
-            operation_type = history.record_body[0]
-            address_pos_begin = operation_type_size
-            address_pos_end = (address_pos_begin + node_uuid_size)
+        for history in histories:
             uuid = self.read_uuid(history.record_body[address_pos_begin:address_pos_end])
 
-            unknown_address = False
-            new_node_address = None
-            channel_idx = 0
-            node = self.ctx.nodes.get(uuid)
-            if node is not None:
-                new_node_address = node.new_node_address
-                channel_idx = node.channel_idx
-                records_added += 1
+            # Serialized address and channel index only depend on the contractor, so they are built once per uuid
+            contractor = self.history_contractors.get(uuid)
+            if contractor is None:
+                contractor = self.resolve_history_contractor(uuid)
+                self.history_contractors[uuid] = contractor
+            addresses_bytes, contractor_id_bytes, known = contractor
+            if known:
+                self.history_records_added += 1
             else:
-                if self.ctx.gns_addresses is not None:
-                    new_node_address = self.ctx.gns_addresses.get(uuid, None)
-                if new_node_address is None:
-                    #print("\tHistory for " + uuid + " skipping...")
-                    records_skipped += 1
-                    unknown_address = True
-                    new_node_address = self.ctx.unknown_address
-                else:
-                    records_added += 1
+                self.history_records_skipped += 1
 
-            contractor_id_bytes = bytearray()
             if history.record_type == trust_line_record_type:
-                contractor_id_bytes = struct.pack("I", channel_idx)
-
-            if new_node_address.find(self.ctx.gns_address_separator) < 0 and not unknown_address:
-                addresses_bytes = bytearray(b'\x01') + self.serialize_ipv4_with_port(new_node_address)
+                record_suffix = b''
             else:
-                addresses_bytes = bytearray(b'\x01') + self.serialize_gns(new_node_address)
-            #print(
-            #    "\tHistory for " + uuid +
-            #    " record_type=" + str(history.record_type) +
-            #    " operation_type=" + str(operation_type) +
-            #    " address=" + new_node_address
-            #)
-
-            history.record_body = \
-                history.record_body[0:address_pos_begin] + \
-                contractor_id_bytes + \
-                addresses_bytes + \
-                history.record_body[address_pos_end:]
-
-            #if history.record_type == payment_record_type:
-            #    history.record_body += bytearray(b'\x00')
-            if history.record_type == payment_record_type:
-                history.record_body += bytearray(b'\x00\x00\x00\x00\x00')
-            elif history.record_type == payment_additional_record_type:
-                history.record_body += bytearray(b'\x00\x00\x00\x00')
-            #elif history.record_type == trust_line_record_type:
-            #    history.record_body += bytearray(b'\x00\x00\x00\x00')
+                contractor_id_bytes = b''
+                if history.record_type == payment_record_type:
+                    record_suffix = b'\x00\x00\x00\x00\x00'
+                elif history.record_type == payment_additional_record_type:
+                    record_suffix = b'\x00\x00\x00\x00'
+                else:
+                    record_suffix = b''
 
-            self.new_storage_cur.execute(
-                "insert into history ("
-                "'operation_uuid', 'operation_timestamp', 'record_type', 'record_body', "
-                "'record_body_bytes_count', 'equivalent', 'command_uuid'"
-                ") "
-                "values (?, ?, ?, ?, ?, ?, ?);",
-                (
-                    history.operation_uuid,
-                    history.operation_timestamp,
-                    history.record_type,
-                    history.record_body,
-                    len(history.record_body),
-                    history.equivalent,
-                    history.command_uuid
-                )
+            record_body = b''.join((
+                history.record_body[0:address_pos_begin],
+                contractor_id_bytes,
+                addresses_bytes,
+                history.record_body[address_pos_end:],
+                record_suffix
+            ))
+            yield (
+                history.operation_uuid,
+                history.operation_timestamp,
+                history.record_type,
+                record_body,
+                len(record_body),
+                history.equivalent,
+                history.command_uuid
             )
-        print(
-            "Generating history for node: " + self.node_name +
-            " added: " + str(records_added) +
-            " unknowned: " + str(records_skipped)
-        )
+
+    def resolve_history_contractor(self, uuid):
+        unknown_address = False
+        new_node_address = None
+        channel_idx = 0
+        node = self.ctx.nodes.get(uuid)
+        if node is not None:
+            new_node_address = node.new_node_address
+            channel_idx = node.channel_idx
+        else:
+            if self.ctx.gns_addresses is not None:
+                new_node_address = self.ctx.gns_addresses.get(uuid, None)
+            if new_node_address is None:
+                unknown_address = True
+                new_node_address = self.ctx.unknown_address
+
+        if new_node_address.find(self.ctx.gns_address_separator) < 0 and not unknown_address:
+            addresses_bytes = bytearray(b'\x01') + self.serialize_ipv4_with_port(new_node_address)
+        else:
+            addresses_bytes = bytearray(b'\x01') + self.serialize_gns(new_node_address)
+        return bytes(addresses_bytes), struct.pack("I", channel_idx), not unknown_address
 
     def migrate(self):
+        self.db_acquire()
         self.trust_lines.clear()
-        if not self.ctx.in_memory:
-            self.db_connect(False)
+        self.trust_lines_by_contractor.clear()
+        self.trust_lines_by_equivalent.clear()
+        # History of an attempt interrupted before it was journaled is written again from scratch
+        self.new_storage_cur.execute("DELETE FROM history;")
         self.migrate_history()
-        self.db_disconnect()
+        self.old_history = []
+        self.db_release(True)
         print()
 
+    def estimate_memory(self):
+        # Rough size in bytes of the cached per-node data, accounted by the memory budget
+        sample_trust_line = next(iter(self.trust_lines.values()), None)
+        sample_channel = next(iter(self.channels.values()), None)
+        sample_own_key = None
+        if self.own_keys is not None:
+            sample_own_keys = next(iter(self.own_keys.values()), [])
+            sample_own_key = sample_own_keys[0] if len(sample_own_keys) > 0 else None
+        return \
+            self.estimate_records(len(self.old_trust_lines), self.old_trust_lines[:1]) + \
+            self.estimate_records(len(self.old_history or []), (self.old_history or [])[:1]) + \
+            self.estimate_records(len(self.trust_lines), [sample_trust_line] if sample_trust_line else []) + \
+            len(self.trust_lines) * 3 * 64 + \
+            self.estimate_records(len(self.channels), [sample_channel] if sample_channel else []) + \
+            self.estimate_records(self.own_keys_count if self.own_keys is not None else 0,
+                                  [sample_own_key] if sample_own_key else [])
+
+    @staticmethod
+    def estimate_records(records_count, samples):
+        if records_count == 0 or len(samples) == 0:
+            return 0
+        record_bytes = sys.getsizeof(samples[0]) + 8
+        for name in type(samples[0]).__slots__:
+            record_bytes += sys.getsizeof(getattr(samples[0], name))
+        return records_count * record_bytes
+
+    def checkpoint_state(self):
+        # Old trust lines are not needed once trust lines are generated, and old history
+        # is streamed from the old storage again (old_history=None) after a resume
+        self.db_acquire(False)
+        state = self.__getstate__()
+        state['old_trust_lines'] = []
+        state['old_history'] = None
+        return state
+
+    @staticmethod
+    def from_checkpoint_state(ctx, state):
+        node_migrator = NodeMigrator.__new__(NodeMigrator)
+        node_migrator.__dict__.update(state)
+        node_migrator.ctx = ctx
+        if ctx.in_memory:
+            node_migrator.db_connect(False)
+        return node_migrator
+
+    def clear_contractor_keys(self):
+        self.db_acquire()
+        self.new_storage_cur.execute("DELETE FROM contractor_keys;")
+        self.db_release()
+
+    def spill(self, spill_path):
+        with open(spill_path, 'wb') as spill_file:
+            pickle.dump(
+                {name: getattr(self, name) for name in self.spilled_attributes},
+                spill_file, pickle.HIGHEST_PROTOCOL)
+        for name in self.spilled_attributes:
+            setattr(self, name, None)
+        self.spill_path = spill_path
+
+    def restore(self):
+        with open(self.spill_path, 'rb') as spill_file:
+            data = pickle.load(spill_file)
+        for name in self.spilled_attributes:
+            setattr(self, name, data[name])
+        os.remove(self.spill_path)
+        self.spill_path = None
+
     def run_and_wait(self, index=1):
+        # The client works on the same storage, so it has to see everything committed
         if self.ctx.in_memory:
             self.db_disconnect()
+        elif self.ctx.connection_pool is not None:
+            self.ctx.connection_pool.release(self)
         #self.ctx.runner.run("cd " + self.new_node_path + ";" + self.client_path + "")
         if 0 == 0:
             with tempfile.TemporaryFile() as client_f:
@@ -291,6 +439,10 @@ class NodeMigrator(NodeGenerator):
                         ["bash", "-c", "cd " + self.new_node_path + ";" + self.client_path + ""],
                         stdout=client_f, stderr=client_f
                     )
-                client_proc.wait()
+                # The client's own usage instead of the cumulative one of all children, its high-water
+                # mark starts from the RSS of this process though (see PhaseProfiler)
+                pid, status, usage = os.wait4(client_proc.pid, 0)
+                client_proc.returncode = os.waitstatus_to_exitcode(status)
+                self.client_rss_high_water_kb = max(self.client_rss_high_water_kb, usage.ru_maxrss)
         if self.ctx.in_memory:
             self.db_connect()
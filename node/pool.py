@@ -0,0 +1,100 @@
+import collections
+import os
+import shutil
+import tempfile
+
+
+class ConnectionPool:
+    # Keeps storages of the most recently used nodes open between calls.
+    # Changes of an open node are committed when it is evicted or released.
+    # With a memory budget, cached data of the nodes is accounted as well, and
+    # least recently used nodes are spilled to disk until the pool fits the budget.
+
+    # Estimated cost of one open node: old and new storage with the default SQLite page cache
+    connection_bytes = 2 * 2000 * 1024
+
+    def __init__(self, max_open_nodes, memory_budget=None):
+        self.max_open_nodes = max(2, max_open_nodes)
+        self.memory_budget = memory_budget
+        self.open_nodes = collections.OrderedDict()
+        self.resident_nodes = collections.OrderedDict()
+        # Estimates of cached node data, open storages are accounted by their count
+        self.nodes_bytes = dict()
+        self.data_bytes = 0
+        self.spill_dir = None
+        self.spilled_count = 0
+        self.restored_count = 0
+
+    @property
+    def used_bytes(self):
+        return self.data_bytes + len(self.open_nodes) * self.connection_bytes
+
+    def acquire(self, node, connect=True):
+        if self.memory_budget is not None:
+            if node.node_name in self.resident_nodes:
+                self.resident_nodes.move_to_end(node.node_name)
+            else:
+                if node.spill_path is not None:
+                    node.restore()
+                    self.restored_count += 1
+                self.resident_nodes[node.node_name] = node
+        if connect:
+            if node.node_name in self.open_nodes:
+                self.open_nodes.move_to_end(node.node_name)
+            else:
+                node.db_connect(False)
+                self.open_nodes[node.node_name] = node
+        self.evict(node)
+
+    def release(self, node):
+        if self.open_nodes.pop(node.node_name, None) is not None:
+            node.db_disconnect(False)
+
+    def evict(self, recent_node):
+        while len(self.open_nodes) > self.max_open_nodes:
+            node_name, node = self.open_nodes.popitem(last=False)
+            node.db_disconnect(False)
+        if self.memory_budget is None:
+            return
+
+        # The most recent node was just changed or is about to be, so its estimate is refreshed
+        self.update_bytes(recent_node)
+        # The two most recent nodes are kept resident, a channel works on both of them at once
+        while self.used_bytes > self.memory_budget and len(self.resident_nodes) > 2:
+            node_name, node = self.resident_nodes.popitem(last=False)
+            self.release(node)
+            self.data_bytes -= self.nodes_bytes.pop(node_name, 0)
+            if self.spill_dir is None:
+                self.spill_dir = tempfile.mkdtemp(prefix="geo_migration_spill_")
+            node.spill(os.path.join(self.spill_dir, node_name + ".bin"))
+            self.spilled_count += 1
+
+    def update_bytes(self, node):
+        node_bytes = node.estimate_memory()
+        self.data_bytes += node_bytes - self.nodes_bytes.get(node.node_name, 0)
+        self.nodes_bytes[node.node_name] = node_bytes
+
+    def release_all(self):
+        while len(self.open_nodes) > 0:
+            node_name, node = self.open_nodes.popitem(last=False)
+            node.db_disconnect(False)
+
+    def close(self):
+        self.release_all()
+        if self.memory_budget is not None:
+            print("Memory budget: nodes spilled " + str(self.spilled_count) +
+                  " times, restored " + str(self.restored_count) + " times")
+        self.resident_nodes.clear()
+        self.nodes_bytes.clear()
+        self.data_bytes = 0
+        if self.spill_dir is not None:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+            self.spill_dir = None
+
+    @staticmethod
+    def parse_size(size):
+        units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+        size = size.strip().upper().rstrip("B")
+        if len(size) > 0 and size[-1] in units:
+            return int(float(size[:-1]) * units[size[-1]])
+        return int(size)
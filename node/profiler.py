@@ -0,0 +1,142 @@
+import contextlib
+import logging
+import resource
+import time
+
+
+class PhaseProfiler:
+    # Wall time, CPU time, SQLite rows read/written and peak RSS of every migration phase
+    # and of every node step in it. Node steps are kept on the node (phase_stats), so steps
+    # run in worker processes come back with the pickled node. CPU of children covers
+    # the worker processes and the node clients, once they have been waited for.
+    # The peak RSS is the peak of the step itself: the high-water mark of the process is reset
+    # when a step starts (Linux clear_refs), where it can't be reset the report says so
+    # (peak_rss_per_step false) and the peaks are those of the process so far. rss_change_kb is
+    # the RSS at the end of the step less the one at its start.
+    # The clients' own peak can't be told: Linux carries the high-water mark of the parent over
+    # fork and exec, so the children_rss_high_water_kb of a node step, the largest ru_maxrss of
+    # the clients it waited for, is never below the RSS of the migration when they started.
+    # Only values above peak_rss_kb say something about the clients.
+    def __init__(self):
+        self.phases = dict()
+        self.started = time.time()
+        self.peak_rss_per_step = True
+
+    @staticmethod
+    def sample():
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return (time.perf_counter(),
+                usage.ru_utime + usage.ru_stime,
+                children_usage.ru_utime + children_usage.ru_stime)
+
+    def reset_peak_rss(self):
+        try:
+            with open("/proc/self/clear_refs", 'w') as clear_refs_file:
+                clear_refs_file.write("5")
+        except OSError:
+            self.peak_rss_per_step = False
+
+    @staticmethod
+    def read_rss():
+        # Current and peak RSS in KB
+        rss_kb = peak_rss_kb = None
+        try:
+            with open("/proc/self/status") as status_file:
+                for line in status_file:
+                    if line.startswith("VmRSS:"):
+                        rss_kb = int(line.split()[1])
+                    elif line.startswith("VmHWM:"):
+                        peak_rss_kb = int(line.split()[1])
+        except OSError:
+            pass
+        if peak_rss_kb is None:
+            peak_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss_kb or 0, peak_rss_kb
+
+    def start(self):
+        self.reset_peak_rss()
+        return self.sample(), self.read_rss()[0]
+
+    def measure(self, start, rows_read, rows_written, children_rss_high_water_kb):
+        end = self.sample()
+        rss_kb, peak_rss_kb = self.read_rss()
+        start, start_rss_kb = start
+        return {
+            "wall": end[0] - start[0],
+            "cpu": end[1] - start[1],
+            "children_cpu": end[2] - start[2],
+            "rows_read": rows_read,
+            "rows_written": rows_written,
+            "peak_rss_kb": peak_rss_kb,
+            "rss_change_kb": rss_kb - start_rss_kb,
+            "children_rss_high_water_kb": children_rss_high_water_kb,
+        }
+
+    def add(self, phase, stats, nodes_count):
+        totals = self.phases.get(phase)
+        if totals is None:
+            totals = self.phases[phase] = {
+                "wall": 0.0, "cpu": 0.0, "children_cpu": 0.0, "rows_read": 0, "rows_written": 0,
+                "peak_rss_kb": 0, "rss_change_kb": 0, "children_rss_high_water_kb": 0, "nodes": 0}
+        for name in ("wall", "cpu", "children_cpu", "rows_read", "rows_written", "rss_change_kb"):
+            totals[name] += stats[name]
+        for name in ("peak_rss_kb", "children_rss_high_water_kb"):
+            totals[name] = max(totals[name], stats[name])
+        totals["nodes"] += nodes_count
+
+    @contextlib.contextmanager
+    def phase(self, phase, nodes):
+        # Phase working on many nodes at once, nodes is the dict of node migrators by name,
+        # read again at the end since nodes may be replaced in it meanwhile
+        # Such a phase runs no node clients, the workers of a parallel phase report their own peaks
+        # with their node steps
+        rows_before = {node_name: node.storage_rows() for node_name, node in nodes.items()}
+        start = self.start()
+        yield
+        rows_read = rows_written = 0
+        for node_name, node in nodes.items():
+            node_rows_read, node_rows_written = node.storage_rows()
+            before = rows_before.get(node_name, (0, 0))
+            rows_read += node_rows_read - before[0]
+            rows_written += node_rows_written - before[1]
+        self.add(phase, self.measure(start, rows_read, rows_written, 0), 0)
+
+    @contextlib.contextmanager
+    def node_phase(self, phase, node):
+        rows_before = node.storage_rows()
+        node.client_rss_high_water_kb = 0
+        start = self.start()
+        yield
+        rows_after = node.storage_rows()
+        stats = self.measure(start, rows_after[0] - rows_before[0], rows_after[1] - rows_before[1],
+                             node.client_rss_high_water_kb)
+        node.phase_stats[phase] = stats
+        self.add(phase, stats, 1)
+
+    def add_node(self, node, phases):
+        # Node steps measured in a worker process
+        for phase in phases:
+            stats = node.phase_stats.get(phase)
+            if stats is not None:
+                self.add(phase, stats, 1)
+
+    def report(self, nodes, resumed, jobs):
+        return {
+            "started": self.started,
+            "resumed": resumed,
+            "jobs": jobs,
+            "peak_rss_per_step": self.peak_rss_per_step,
+            # A list, so phases stay in the order they ran
+            "phases": [dict(totals, phase=phase) for phase, totals in self.phases.items()],
+            "nodes": {node.node_name: node.phase_stats for node in nodes},
+        }
+
+    def log_summary(self):
+        logger = logging.getLogger()
+        for phase, totals in self.phases.items():
+            logger.info("Phase %s: wall %.2fs, cpu %.2fs (children %.2fs), rows read %d, written %d, "
+                        "peak RSS %d KB, RSS change %+d KB (children high-water %d KB)",
+                        phase, totals["wall"], totals["cpu"], totals["children_cpu"],
+                        totals["rows_read"], totals["rows_written"],
+                        totals["peak_rss_kb"], totals["rss_change_kb"], totals["children_rss_high_water_kb"])
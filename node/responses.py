@@ -0,0 +1,94 @@
+import array
+
+
+class ResponseLayout:
+    # Fixed-stride record layout of a node command response "uuid\tcode\tcount\tfields...":
+    # every record is stride consecutive fields. Field types are 'q' (int) and 'd' (float),
+    # which are decoded into typed arrays, and str, which stays a list of strings.
+    def __init__(self, command, fields):
+        self.command = command
+        self.fields = fields
+        self.stride = len(fields)
+
+    def decode(self, response):
+        # The response is split once and every field is taken as one strided slice,
+        # so numbers are converted column by column instead of record by record
+        if isinstance(response, bytes):
+            response = response.decode("utf-8")
+        values = response.rstrip('\n').split('\t')
+        count = int(values[2])
+        end = 3 + count * self.stride
+        if len(values) < end:
+            assert False, self.command + " response holds " + str(len(values) - 3) + " fields, " + \
+                          str(count) + " records of " + str(self.stride) + " expected"
+        columns = ResponseColumns(count)
+        for f, (name, field_type) in enumerate(self.fields):
+            column = values[3 + f:end:self.stride]
+            if field_type == 'q':
+                column = array.array('q', map(int, column))
+            elif field_type == 'd':
+                column = array.array('d', map(float, column))
+            setattr(columns, name, column)
+        return columns
+
+
+class ResponseColumns:
+    # Decoded records of one response, one attribute per field
+    def __init__(self, count):
+        self.count = count
+
+
+def decode_values(response):
+    # Plain list response, like the equivalents: "uuid\tcode\tcount\tvalue\t..."
+    if isinstance(response, bytes):
+        response = response.decode("utf-8")
+    values = response.rstrip('\n').split('\t')
+    count = int(values[2])
+    return values[3:3 + count]
+
+
+OLD_TRUST_LINES = ResponseLayout('GET:contractors/trust-lines (old node)', (
+    ("contractor_id", str),
+    ("incoming_trust_amount", 'd'),
+    ("outgoing_trust_amount", 'd'),
+    ("balance", 'd'),
+))
+
+NEW_TRUST_LINES = ResponseLayout('GET:contractors/trust-lines', (
+    ("contractor_id", 'q'),
+    ("addresses", str),
+    ("state", 'q'),
+    ("own_keys", 'q'),
+    ("contractor_keys", 'q'),
+    ("incoming_trust_amount", 'd'),
+    ("outgoing_trust_amount", 'd'),
+    ("balance", 'd'),
+))
+
+HISTORY_TRUST_LINES = ResponseLayout('GET:history/trust-lines', (
+    ("transaction_uuid", str),
+    ("timestamp", 'q'),
+    ("addresses", str),
+    ("operation_type", str),
+    ("sum", 'd'),
+))
+
+OLD_HISTORY_PAYMENTS = ResponseLayout('GET:history/payments (old node)', (
+    ("transaction_uuid", str),
+    ("timestamp", 'q'),
+    ("addresses", str),
+    ("payment_type", str),
+    ("sum", 'd'),
+    ("balance", 'd'),
+))
+
+# The new node appends one more field to every payment, it is not compared
+NEW_HISTORY_PAYMENTS = ResponseLayout('GET:history/payments', (
+    ("transaction_uuid", str),
+    ("timestamp", 'q'),
+    ("addresses", str),
+    ("payment_type", str),
+    ("sum", 'd'),
+    ("balance", 'd'),
+    ("additional_data", str),
+))
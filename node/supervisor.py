@@ -0,0 +1,109 @@
+import collections
+import threading
+
+
+class RunningNode:
+    __slots__ = (
+        "executor",
+        "node_handle",
+        "result_fifo_path",
+        "busy",
+    )
+
+    def __init__(self, executor, node_handle, result_fifo_path):
+        self.executor = executor
+        self.node_handle = node_handle
+        self.result_fifo_path = result_fifo_path
+        self.busy = True
+
+
+class NodeSupervisor:
+    # Keeps up to max_running_nodes started node processes, keyed by node path, so that
+    # a node asked for again is reused instead of started anew. When the limit is reached
+    # idle nodes are stopped least recently used first, busy ones are never stopped.
+    # Nodes that are going to be needed soon can be started ahead in the background.
+
+    def __init__(self, max_running_nodes):
+        self.max_running_nodes = max(1, max_running_nodes)
+        self.running_nodes = collections.OrderedDict()
+        self.starting_nodes = set()
+        self.lock = threading.Condition()
+        self.started_count = 0
+        self.reused_count = 0
+
+    def acquire(self, executor, node_path, client_path, commands_fifo_path, result_fifo_path, verbose=True):
+        with self.lock:
+            # A node started ahead is waited for rather than started twice
+            self.lock.wait_for(lambda: node_path not in self.starting_nodes)
+            running_node = self.running_nodes.get(node_path)
+            if running_node is not None:
+                if running_node.node_handle.poll() is None:
+                    running_node.busy = True
+                    self.running_nodes.move_to_end(node_path)
+                    self.reused_count += 1
+                    return running_node.node_handle
+                del self.running_nodes[node_path]
+                running_node.executor.stop_node(running_node.node_handle, running_node.result_fifo_path)
+            self.starting_nodes.add(node_path)
+
+        node_handle = None
+        try:
+            node_handle = executor.start_node(node_path, client_path, commands_fifo_path, result_fifo_path, verbose)
+        finally:
+            with self.lock:
+                self.starting_nodes.discard(node_path)
+                if node_handle is not None:
+                    self.running_nodes[node_path] = RunningNode(executor, node_handle, result_fifo_path)
+                    self.started_count += 1
+                    self.evict()
+                self.lock.notify_all()
+        return node_handle
+
+    def release(self, node_path, keep=True):
+        with self.lock:
+            running_node = self.running_nodes.get(node_path)
+            if running_node is None:
+                return
+            running_node.busy = False
+            if keep:
+                self.running_nodes.move_to_end(node_path)
+                self.evict()
+            else:
+                del self.running_nodes[node_path]
+                running_node.executor.stop_node(running_node.node_handle, running_node.result_fifo_path)
+
+    def prestart(self, executor, node_path, client_path, commands_fifo_path, result_fifo_path):
+        # Only uses free room, a node started ahead never pushes out a running one
+        with self.lock:
+            if node_path in self.running_nodes or node_path in self.starting_nodes:
+                return
+            if len(self.running_nodes) + len(self.starting_nodes) >= self.max_running_nodes:
+                return
+        threading.Thread(
+            target=self.start_ahead,
+            args=(executor, node_path, client_path, commands_fifo_path, result_fifo_path)).start()
+
+    def start_ahead(self, executor, node_path, client_path, commands_fifo_path, result_fifo_path):
+        try:
+            self.acquire(executor, node_path, client_path, commands_fifo_path, result_fifo_path, False)
+            self.release(node_path)
+        except Exception as e:
+            print("Failed to start node ahead: " + str(e))
+
+    def evict(self):
+        for node_path in list(self.running_nodes.keys()):
+            if len(self.running_nodes) <= self.max_running_nodes:
+                break
+            running_node = self.running_nodes[node_path]
+            if running_node.busy:
+                continue
+            del self.running_nodes[node_path]
+            running_node.executor.stop_node(running_node.node_handle, running_node.result_fifo_path)
+
+    def close(self):
+        with self.lock:
+            self.lock.wait_for(lambda: len(self.starting_nodes) == 0)
+            while len(self.running_nodes) > 0:
+                node_path, running_node = self.running_nodes.popitem(last=False)
+                running_node.executor.stop_node(running_node.node_handle, running_node.result_fifo_path)
+        print("Node processes: started " + str(self.started_count) + ", reused " + str(self.reused_count))
@@ -1,8 +1,8 @@
 import os
-import threading
 import time
 import json
 
+from node import responses
 from node.executor import NodeExecutor
 
 
@@ -37,12 +37,8 @@ class NodeValidator(NodeExecutor):
         self.db_disconnect(False)
 
     def init(self, verbose=True):
-        new_node_result_fifo_thread = \
-            threading.Thread(target=self.open_node_result_fifo, args=(self.new_result_fifo_path, verbose))
-        new_node_result_fifo_thread.start()
-
-        self.node_handle = self.run_node(self.new_node_path, self.new_client_path, verbose)
-        time.sleep(0.2)
+        self.node_handle = self.acquire_node(
+            self.new_node_path, self.new_client_path, self.new_commands_fifo_path, self.new_result_fifo_path, verbose)
 
         print("\tRequesting equivalents for node (FOR TESTING NODE)" + str(self.node_name) + "...")
         result_eq = self.run_command(
@@ -162,48 +158,39 @@ class NodeValidator(NodeExecutor):
         return trust_line_changed
 
     def clear(self):
-        self.node_handle.terminate()
         #os.killpg(os.getpgid(self.node_handle.pid), signal.SIGTERM)
-        self.clean()
+        self.release_node(self.node_handle, self.new_node_path, self.new_result_fifo_path)
 
     def get_trust_lines(self):
         print("\tRequesting equivalents for node " + str(self.node_name) + "...")
         result_eq = self.run_command(
             self.new_commands_fifo_path,
-            '13e5cf8c-5834-4e52-b65b-f9281dd1ff91\tGET:equivalents\n').decode("utf-8")
-        result_eq = result_eq.split('\t')
-        eq_count = int(result_eq[2])
-        print("\tFound " + str(eq_count) + " equivalents")
+            '13e5cf8c-5834-4e52-b65b-f9281dd1ff91\tGET:equivalents\n')
+        equivalents = [int(eq) for eq in responses.decode_values(result_eq)]
+        print("\tFound " + str(len(equivalents)) + " equivalents")
         trust_lines = []
-        for e in range(eq_count):
-            eq = int(result_eq[e + 3])
-            print("\t\tRequesting trust lines for equivalent " + str(eq) + "...")
-            result_tl = self.run_command(
-                self.new_commands_fifo_path,
-                '13e5cf8c-5834-4e52-b65b-f9281dd1ff91\tGET:contractors/trust-lines\t0\t100000\t' + str(eq) + '\n'). \
-                decode("utf-8")
-            result_tl = result_tl.split('\t')
-            tl_count = int(result_tl[2])
-            print("\t\tFound " + str(tl_count) + " trust lines")
-            for t in range(tl_count):
-                trust_line_array_shift = t * 8 + 3
-                contractor_id = int(result_tl[trust_line_array_shift + 0])
-                addresses = result_tl[trust_line_array_shift + 1]
-                state = int(result_tl[trust_line_array_shift + 2])
-                own_keys = int(result_tl[trust_line_array_shift + 3])
-                contractor_keys = int(result_tl[trust_line_array_shift + 4])
-                incoming_trust_amount = float(result_tl[trust_line_array_shift + 5])
-                outgoing_trust_amount = float(result_tl[trust_line_array_shift + 6])
-                balance = float(result_tl[trust_line_array_shift + 7])
+        print("\t\tRequesting trust lines for all equivalents...")
+        results = self.run_commands(
+            self.new_commands_fifo_path,
+            ['GET:contractors/trust-lines\t0\t100000\t' + str(eq) + '\n' for eq in equivalents])
+        for e, eq in enumerate(equivalents):
+            self.ctx.logger.debug("\t\tTrust lines for equivalent %s:", eq)
+            decoded_trust_lines = responses.NEW_TRUST_LINES.decode(results[e])
+            self.ctx.logger.debug("\t\tFound %s trust lines", decoded_trust_lines.count)
+            self.ctx.count_records("validate", "trust lines", decoded_trust_lines.count)
+            for t, (contractor_id, addresses, state, own_keys, contractor_keys,
+                    incoming_trust_amount, outgoing_trust_amount, balance) in enumerate(zip(
+                    decoded_trust_lines.contractor_id, decoded_trust_lines.addresses,
+                    decoded_trust_lines.state, decoded_trust_lines.own_keys,
+                    decoded_trust_lines.contractor_keys, decoded_trust_lines.incoming_trust_amount,
+                    decoded_trust_lines.outgoing_trust_amount, decoded_trust_lines.balance)):
                 address = addresses[addresses.find(' ') + 1:]
                 node = self.ctx.nodes_by_address.get(address)
                 if node is None:
                     assert False, "Can't find node by address " + address
-                print("\t\t\tTrust line " + str(t+1) + ":" +
-                      " id="+str(node.node_name) + ";" +
-                      " incoming=" + str(incoming_trust_amount) + ";" +
-                      " outgoing=" + str(outgoing_trust_amount) + ";" +
-                      " balance=" + str(balance))
+                self.ctx.logger.debug(
+                    "\t\t\tTrust line %s: id=%s; incoming=%s; outgoing=%s; balance=%s",
+                    t + 1, node.node_name, incoming_trust_amount, outgoing_trust_amount, balance)
                 trust_line = NodeValidator.TrustLine()
                 trust_lines.append(trust_line)
                 trust_line.node = node
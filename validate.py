@@ -4,6 +4,7 @@ import os
 import sys
 import time
 
+from node.supervisor import NodeSupervisor
 from node.validator import NodeValidator
 
 from node import context
@@ -13,8 +14,9 @@ from settings import migration_conf
 class Main(context.Context):
     def __init__(self):
         super().__init__()
+        self.warm_nodes = 16
         try:
-            opts, args = getopt.getopt(sys.argv[1:], "hvc", ["help", "clean"])
+            opts, args = getopt.getopt(sys.argv[1:], "hvc", ["help", "clean", "ready-probe=", "ready-timeout=", "warm-nodes="])
         except getopt.GetoptError as err:
             print(str(err))
             self.usage()
@@ -27,8 +29,16 @@ class Main(context.Context):
             elif o in ("-h", "--help"):
                 self.usage()
                 sys.exit()
+            elif o == "--ready-probe":
+                assert a in ("marker", "fifo", "ping"), "unknown readiness probe " + a
+                self.node_ready_probe = a
+            elif o == "--ready-timeout":
+                self.node_ready_timeout = float(a)
+            elif o == "--warm-nodes":
+                self.warm_nodes = int(a)
             else:
                 assert False, "unhandled option"
+        self.set_logging_level()
         self.in_memory = True
         self.old_network_client_path = migration_conf.get("old_network_client_path")
         self.new_network_client_path = migration_conf.get("new_network_client_path")
@@ -55,6 +65,10 @@ class Main(context.Context):
             self.nodes[node_validator.node_name] = node_validator
             self.nodes_by_address[node_validator.new_node_address] = node_validator
 
+        # Contractors are asked for again and again, so their started processes are reused
+        if self.warm_nodes > 0:
+            self.node_supervisor = NodeSupervisor(self.warm_nodes)
+
         nodes_succeeded_count = 0
         nodes_failed_count = 0
         sorted_nodes = sorted(self.nodes.values(), key=operator.attrgetter('trust_lines_count'), reverse=True)
@@ -69,9 +83,15 @@ class Main(context.Context):
             else:
                 nodes_failed_count += 1
 
+        if self.node_supervisor is not None:
+            self.node_supervisor.close()
+            self.node_supervisor = None
+
         print("Calculating node_validation outcome...")
         print("Succeeded=" + str(nodes_succeeded_count) + " Failed=" + str(nodes_failed_count) +
               " All=" + str(len(self.nodes)))
+        self.report_node_start_up()
+        self.log_phase_counters("validate")
 
     def clean_validation_data(self, nodes):
         all_nodes = os.listdir(self.old_infrastructure_path) if nodes is None else nodes
@@ -91,6 +111,9 @@ class Main(context.Context):
         print("Usage:")
         print("\tpython validate.py [-v]")
         print("\t\t [-c --clean] : clean validated nodes flags")
+        print("\t\t [--ready-probe=marker|fifo|ping] : how to detect that a started node takes commands (default: fifo)")
+        print("\t\t [--ready-timeout=seconds] : how long to wait for a started node (default: 30)")
+        print("\t\t [--warm-nodes=N] : node processes kept running and reused (default: 16, 0 disables)")
         print("Example:")
         print("\tpython validate.py")
 